@@ -1,6 +1,11 @@
 import os
-from flask import Blueprint, request, jsonify
-from db import get_movies, get_movies_by_release_year, sort_movies, get_movies_by_genres, get_movie_reviews, get_movie
+from bson.objectid import ObjectId
+from flask import Blueprint, request, jsonify, current_app, stream_with_context
+from db import get_movies, get_movies_by_release_year, sort_movies, get_movies_by_genres, get_movie_reviews, get_movie, \
+    get_movies_by_ids, StreamedResults
+from cache import movie_cache, cached_json_response, cached_json_list_response, get_cache_key
+from projections import get_projection
+from indexes import SORTABLE_MOVIE_FIELDS
 from flask_cors import CORS
 
 movies_api = Blueprint(
@@ -9,6 +14,63 @@ movies_api = Blueprint(
 CORS(movies_api)
 DEFAULT_ITEMS_PER_PAGE = os.getenv('DEFAULT_ITEMS_PER_PAGE')
 DEFAULT_ITEMS_PER_PAGE = int(DEFAULT_ITEMS_PER_PAGE) if DEFAULT_ITEMS_PER_PAGE else 20
+MAX_MOVIE_IDS = int(os.getenv('MAX_MOVIE_IDS', 300))
+# ?stream=json|ndjson pages can be larger, up to ?limit=MAX_STREAM_ITEMS_PER_PAGE items
+MAX_STREAM_ITEMS_PER_PAGE = int(os.getenv('MAX_STREAM_ITEMS_PER_PAGE', 10000))
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_MIMETYPES = {"json": "application/json", "ndjson": "application/x-ndjson"}
+
+
+def get_list_param(name):
+    # a list parameter can be repeated (?ids=a&ids=b) or comma separated (?ids=a,b)
+    return [value for values in request.args.getlist(name) for value in values.split(',') if value]
+
+
+def get_request_projection(collection):
+    # ?fields=title,poster selects the fields, ?profile=card a named set of them (see projections.PROFILES)
+    return get_projection(collection, get_list_param('fields'), request.args.get('profile') or None)
+
+
+def stream_items(items, response, stream_format):
+    """
+        Stream a page while its items are read from the database, encoding and sending them STREAM_CHUNK_SIZE
+        characters at a time.
+
+        "json" sends the same object as jsonify, with next_cursor and has_more after the items. "ndjson" sends an item
+        per line, the last line being the response without the items.
+    """
+    dumps = current_app.json.dumps
+
+    def generate():
+        chunk = []
+        size = 0
+
+        if stream_format == "json":
+            yield '{"items": ['
+
+        for idx, item in enumerate(items):
+            fragment = dumps(item) + "\n" if stream_format == "ndjson" else ("," if idx else "") + dumps(item)
+            chunk.append(fragment)
+            size += len(fragment)
+
+            if size >= STREAM_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+
+        # the continuation token is known once the items have been read
+        if isinstance(items, StreamedResults):
+            response["next_cursor"] = items.next_cursor
+        response["has_more"] = response["next_cursor"] is not None
+
+        if stream_format == "json":
+            # the rest of the response, without its opening brace
+            chunk.append("], " + dumps(response)[1:])
+        else:
+            chunk.append(dumps(response) + "\n")
+        yield "".join(chunk)
+
+    return current_app.response_class(stream_with_context(generate()), mimetype=STREAM_MIMETYPES[stream_format])
 
 
 def paginate_items(get_movies_func, **kwargs):
@@ -18,10 +80,36 @@ def paginate_items(get_movies_func, **kwargs):
         print('Got bad value:', e)
         page = 0
 
-    offset = page * DEFAULT_ITEMS_PER_PAGE
+    # ?stream=json or ?stream=ndjson sends the items while they are read instead of loading the whole page
+    stream_format = request.args.get('stream') or None
+    if stream_format is not None and stream_format not in STREAM_MIMETYPES:
+        return jsonify({"error": f"stream must be one of {', '.join(STREAM_MIMETYPES)}"}), 400
+
+    items_per_page = DEFAULT_ITEMS_PER_PAGE
+    if stream_format:
+        try:
+            items_per_page = min(int(request.args.get('limit', DEFAULT_ITEMS_PER_PAGE)), MAX_STREAM_ITEMS_PER_PAGE)
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+        if items_per_page <= 0:
+            return jsonify({"error": "limit must be positive"}), 400
+
+    # keyset pagination: the continuation token of the previous page replaces the page offset
+    cursor = request.args.get('cursor') or None
+    offset = 0 if cursor else page * items_per_page
+
+    # ?count=none skips the total, ?count=facet or ?count=cached avoid the extra count_documents round-trip
+    count = request.args.get('count') or None
+
+    result = get_movies_func(offset=offset, items_per_page=items_per_page, cursor=cursor, count=count,
+                             stream=stream_format is not None, **kwargs)
+
+    # the queries return their errors: an invalid cursor, count mode or sort is the client's
+    if isinstance(result, ValueError):
+        return jsonify({"error": str(result)}), 400
 
     try:
-        movies, total_results = get_movies_func(offset=offset, items_per_page=DEFAULT_ITEMS_PER_PAGE, **kwargs)
+        movies, total_results, next_cursor = result
     except TypeError as e:
         print('Got bad value:', e)
         return {}
@@ -29,10 +117,16 @@ def paginate_items(get_movies_func, **kwargs):
     response = {
         "items": movies,
         "page": page,
-        "entries_per_page": DEFAULT_ITEMS_PER_PAGE,
+        "entries_per_page": items_per_page,
         "total_results": total_results,
+        "next_cursor": next_cursor,
+        "has_more": next_cursor is not None,
     }
 
+    if stream_format:
+        del response["items"]
+        return stream_items(movies, response, stream_format)
+
     return jsonify(response)
 
 
@@ -54,14 +148,76 @@ def api_get_movies_by_release_year(year):
 
 @movies_api.route('/sort/<field>/<order>', methods=['GET'])
 def api_sort_movies(field, order):
+    if field not in SORTABLE_MOVIE_FIELDS or order not in ['1', '-1']:
+        return jsonify({"error": f"Movies can be sorted by {', '.join(SORTABLE_MOVIE_FIELDS)} in order 1 or -1"}), 400
+
     return paginate_items(sort_movies, field=field, order=order)
 
 
 @movies_api.route('/reviews/<movie_id>', methods=['GET'])
 def api_get_movies_reviews(movie_id):
-    return paginate_items(get_movie_reviews, movie_id=movie_id)
+    try:
+        projection = get_request_projection("review")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return paginate_items(get_movie_reviews, movie_id=movie_id, projection=projection)
 
 
 @movies_api.route('/get_movie/<movie_id>', methods=['GET'])
 def api_get_movie(movie_id):
-    return get_movie(movie_id)
+    try:
+        projection = get_request_projection("movie")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not ObjectId.is_valid(movie_id):
+        return jsonify({"error": "Invalid movie ID format."}), 400
+
+    if projection is not None:
+        movie = get_movie(movie_id, projection)
+        return jsonify(movie) if movie is not None else (jsonify({"error": "Movie not found."}), 404)
+
+    response = cached_json_response(movie_cache, get_cache_key(movie_id), lambda: get_movie(movie_id))
+
+    if response is None:
+        return jsonify({"error": "Movie not found."}), 404
+
+    return response
+
+
+@movies_api.route('/get_movies_by_ids', methods=['GET', 'POST'])
+def api_get_movies_by_ids():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        movie_ids = data.get('ids')
+        fields = data.get('fields')
+        profile = data.get('profile')
+    else:
+        movie_ids = get_list_param('ids')
+        fields = get_list_param('fields')
+        profile = request.args.get('profile') or None
+
+    if not isinstance(movie_ids, list) or not movie_ids:
+        return jsonify({"error": "Missing required parameter ids"}), 400
+    if len(movie_ids) > MAX_MOVIE_IDS:
+        return jsonify({"error": f"At most {MAX_MOVIE_IDS} ids per request"}), 400
+    if not all(isinstance(movie_id, str) and ObjectId.is_valid(movie_id) for movie_id in movie_ids):
+        return jsonify({"error": "Invalid movie ID format."}), 400
+    if fields is not None and not isinstance(fields, list):
+        return jsonify({"error": "fields must be a list of field names"}), 400
+
+    try:
+        projection = get_projection("movie", fields, profile)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # the writes evict the cache by the canonical id
+    movie_ids = [get_cache_key(movie_id) for movie_id in movie_ids]
+
+    if projection is None:
+        # whole documents: the same cache as get_movie
+        return cached_json_list_response(movie_cache, movie_ids, get_movies_by_ids)
+
+    movies = get_movies_by_ids(list(dict.fromkeys(movie_ids)), projection)
+    return jsonify({"items": [movies.get(movie_id) for movie_id in movie_ids]})
@@ -2,6 +2,9 @@ import json
 from datetime import datetime
 from http.client import responses
 
+from api.movies import get_request_projection
+from bson.objectid import ObjectId
+from cache import troupe_cache, cached_json_response, get_cache_key
 from db import get_troupe
 from flask import Blueprint, request, jsonify
 from flask_cors import CORS
@@ -14,5 +17,22 @@ CORS(troupe_api)
 
 @troupe_api.route('/get_troupe/<troupe_id>', methods=['GET'])
 def api_get_troupe(troupe_id):
-    return get_troupe(troupe_id)
+    try:
+        projection = get_request_projection("troupe")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not ObjectId.is_valid(troupe_id):
+        return jsonify({"error": "Invalid troupe ID format."}), 400
+
+    if projection is not None:
+        troupe = get_troupe(troupe_id, projection)
+        return jsonify(troupe) if troupe is not None else (jsonify({"error": "Troupe not found."}), 404)
+
+    response = cached_json_response(troupe_cache, get_cache_key(troupe_id), lambda: get_troupe(troupe_id))
+
+    if response is None:
+        return jsonify({"error": "Troupe not found."}), 404
+
+    return response
 
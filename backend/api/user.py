@@ -2,8 +2,11 @@ import json
 from datetime import datetime
 from http.client import responses
 
+from api.movies import paginate_items
+from bson.objectid import ObjectId
 from db import get_movie, add_movie_to_user_list, update_movie_in_user_list, delete_movie_from_user_list, \
-    get_movies_user_list, add_review, update_review, apple_sign_in
+    get_movies_user_list, get_movies_user_list_page, add_review, update_review, apple_sign_in, \
+    apply_user_list_operations, MAX_USER_LIST_OPERATIONS
 from flask import Blueprint, request, jsonify
 from flask_cors import CORS
 
@@ -39,7 +42,7 @@ def api_add_movie_to_user_list():
 
     result = add_movie_to_user_list(user_id, movie_id, title, poster, watched, favourite)
 
-    if result.modified_count > 0:
+    if result["modified_count"] > 0:
         return jsonify({"message": "Successfully added movie."})
     else:
         return jsonify({"message": "No documents were added."})
@@ -60,7 +63,7 @@ def api_update_movie_in_user_list():
 
     result = update_movie_in_user_list(user_id, movie_id, watched, favourite)
 
-    if result.modified_count > 0:
+    if result["modified_count"] > 0:
         return jsonify({"message": "Successfully updated the movie's watched status."})
     else:
         return jsonify({"message": "No documents were updated. Either the user or movie was not found."}), 200
@@ -71,7 +74,7 @@ def api_delete_movie_from_user_list(user_id: str, movie_id: str):
     try:
         result = delete_movie_from_user_list(user_id, movie_id)
 
-        if result.modified_count > 0:
+        if result["modified_count"] > 0:
             return json.dumps({"message": "Movie removed successfully."}), 200
         else:
             return json.dumps({"Movie not found in user's list.": responses[404]}), 200  # 404 Not Found
@@ -82,10 +85,38 @@ def api_delete_movie_from_user_list(user_id: str, movie_id: str):
         return json.dumps({"Error deleting movie": responses[500]}), 500  # 500 Internal Server Error
 
 
+@user_api.route('/batch_user_list', methods=['POST'])
+def api_batch_user_list():
+    data = request.get_json()
+    user_id = data.get('user_id')
+    operations = data.get('operations')
+    ordered = data.get('ordered', True)
+    ordered = ordered.lower() == 'true' if isinstance(ordered, str) else bool(ordered)
+
+    if not user_id or not isinstance(operations, list):
+        return jsonify({"error": "Missing required parameters"}), 400
+
+    if not isinstance(user_id, str) or not ObjectId.is_valid(user_id):
+        return jsonify({"error": "Invalid user ID format."}), 400
+
+    if len(operations) > MAX_USER_LIST_OPERATIONS:
+        return jsonify({"error": f"At most {MAX_USER_LIST_OPERATIONS} operations per batch"}), 400
+
+    results = apply_user_list_operations(user_id, operations, ordered)
+
+    return jsonify({"results": results})
+
+
 @user_api.route('/get_movies_user_list/<user_id>/<watched>/<favourite>', methods=['GET'])
 def api_get_movies_user_list(user_id, watched, favourite):
     watched = watched.lower() == 'true'
     favourite = favourite.lower() == 'true'
+
+    # paginated and sortable (?sort=added|title) when a page or a cursor is asked for, the whole list otherwise
+    if any(arg in request.args for arg in ['page', 'cursor', 'sort']):
+        return paginate_items(get_movies_user_list_page, user_id=user_id, watched=watched, favourite=favourite,
+                              sort=request.args.get('sort', 'added'))
+
     movies_list = get_movies_user_list(user_id, watched, favourite)
     return jsonify(movies_list)
 
@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+from flask import current_app
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# loading variables from .env file
+load_dotenv()
+
+
+class TTLCache:
+    """
+        In-process LRU cache whose entries expire ttl seconds after being set.
+    """
+
+    def __init__(self, max_entries: int = 2048, ttl: int = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [self.get(key) for key in keys]
+
+    def set(self, key: str, value: bytes):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """
+        Cache stored in a (local) Redis server, shared by all the workers. Redis errors are treated as misses.
+    """
+
+    def __init__(self, client, prefix: str, ttl: int = 300):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self.client.get(self.prefix + key)
+        except redis.RedisError as e:
+            print("Redis cache unavailable:", e)
+            return None
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        try:
+            return self.client.mget([self.prefix + key for key in keys]) if keys else []
+        except redis.RedisError as e:
+            print("Redis cache unavailable:", e)
+            return [None] * len(keys)
+
+    def set(self, key: str, value: bytes):
+        try:
+            self.client.set(self.prefix + key, value, ex=self.ttl)
+        except redis.RedisError as e:
+            print("Redis cache unavailable:", e)
+
+    def delete(self, *keys: str):
+        try:
+            if keys:
+                self.client.delete(*[self.prefix + key for key in keys])
+        except redis.RedisError as e:
+            print("Redis cache unavailable:", e)
+
+    def clear(self):
+        try:
+            for key in self.client.scan_iter(match=self.prefix + "*"):
+                self.client.delete(key)
+        except redis.RedisError as e:
+            print("Redis cache unavailable:", e)
+
+
+def create_cache(name: str):
+    """
+        Create the cache selected by CACHE_BACKEND in the .env file: "memory" (default) or "redis" (REDIS_URL).
+
+        A write only evicts the entries of the worker handling it from a "memory" cache: the other workers serve
+        their copy until it expires, so its CACHE_TTL defaults to 30 seconds instead of 300 for "redis".
+
+        :param name: The name of the cache, used to prefix the Redis keys.
+        :return: The cache.
+    """
+    backend = os.getenv("CACHE_BACKEND", "memory")
+    ttl = int(os.getenv("CACHE_TTL", 300 if backend == "redis" else 30))
+
+    if backend == "redis":
+        if redis is None:
+            raise ImportError("CACHE_BACKEND is redis but the redis package is not installed")
+
+        client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        return RedisCache(client, f"{name}:", ttl)
+
+    return TTLCache(int(os.getenv("CACHE_MAX_ENTRIES", 2048)), ttl)
+
+
+def get_cache_key(document_id) -> str:
+    """
+        The key of a document, the same for every spelling of its id (str in any case or ObjectId).
+    """
+    return str(ObjectId(document_id))
+
+
+# detail documents by id, stored already serialized to JSON
+movie_cache = create_cache("movie")
+troupe_cache = create_cache("troupe")
+
+
+def cached_json_response(cache, key: str, loader: Callable[[], Optional[dict]]):
+    """
+        Respond with the JSON body cached under a key, loading and serializing the document on a miss.
+
+        :param cache: The cache.
+        :param key: The key of the document, e.g. its id.
+        :param loader: The function reading the document from the database.
+        :return: The response, or None if the document does not exist.
+    """
+    body = cache.get(key)
+
+    if body is None:
+        document = loader()
+        if document is None:
+            return None
+
+        body = current_app.json.dumps(document).encode()
+        cache.set(key, body)
+
+    return current_app.response_class(body, mimetype="application/json")
+
+
+def cached_json_list_response(cache, keys: List[str], loader: Callable[[List[str]], Dict[str, dict]]):
+    """
+        Respond with {"items": [...]}, the JSON bodies cached under the keys in their order (null for the documents
+        that do not exist). The missed keys are loaded with a single call and cached.
+
+        :param cache: The cache.
+        :param keys: The keys of the documents, e.g. their ids.
+        :param loader: The function reading the documents of the given keys, returning them by key.
+        :return: The response.
+    """
+    bodies = dict(zip(keys, cache.get_many(keys)))
+    missed = [key for key, body in bodies.items() if body is None]
+
+    if missed:
+        for key, document in loader(missed).items():
+            bodies[key] = current_app.json.dumps(document).encode()
+            cache.set(key, bodies[key])
+
+    body = b'{"items":[' + b",".join(bodies[key] or b"null" for key in keys) + b"]}"
+    return current_app.response_class(body, mimetype="application/json")
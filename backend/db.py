@@ -1,26 +1,27 @@
+import base64
 import datetime
 import os
-from typing import Optional, Union, List, Tuple
+import threading
+import time
+from bisect import bisect_right
+from typing import Callable, Iterable, Optional, Union, List, Tuple
 
+from bson import json_util
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
 from flask import g
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne, DeleteOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from werkzeug.local import LocalProxy
 
+from cache import movie_cache, get_cache_key
+from indexes import SORTABLE_MOVIE_FIELDS
+from search import MovieSearchIndex
+
 # loading variables from .env file
 load_dotenv()
 
 
-class Singleton(dict):
-    _instance = None
-
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(Singleton, cls).__new__(cls)
-        return cls._instance
-
-
 def get_db_name():
     return os.getenv("DB_NAME")
 
@@ -51,14 +52,80 @@ def get_connection_string():
     return f"mongodb://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}?retryWrites=true&w=majority"
 
 
+def get_int_env(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def get_client_options() -> dict:
+    """
+        Pool, timeout and read preference options for the shared MongoClient, read from the .env file.
+
+        :return: The keyword arguments to pass to MongoClient.
+    """
+    return {
+        "maxPoolSize": get_int_env("MONGO_MAX_POOL_SIZE", 100),
+        "minPoolSize": get_int_env("MONGO_MIN_POOL_SIZE", 0),
+        "maxIdleTimeMS": get_int_env("MONGO_MAX_IDLE_TIME_MS", None),
+        "connectTimeoutMS": get_int_env("MONGO_CONNECT_TIMEOUT_MS", 5000),
+        "socketTimeoutMS": get_int_env("MONGO_SOCKET_TIMEOUT_MS", None),
+        "serverSelectionTimeoutMS": get_int_env("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+        "waitQueueTimeoutMS": get_int_env("MONGO_WAIT_QUEUE_TIMEOUT_MS", None),
+        "readPreference": os.getenv("MONGO_READ_PREFERENCE", "primary"),
+    }
+
+
 def open_connection():
-    return MongoClient(get_connection_string())
+    return MongoClient(get_connection_string(), **get_client_options())
 
 
 def close_connection(client):
     client.close()
 
 
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+        Return the MongoClient shared by every request of this process, creating it on first use.
+    """
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = open_connection()
+
+    return _client
+
+
+def close_client():
+    """
+        Close the shared MongoClient, e.g. on app shutdown. The next call to get_client opens a new one.
+    """
+    global _client
+
+    with _client_lock:
+        if _client is not None:
+            close_connection(_client)
+            _client = None
+
+
+def _reset_client_after_fork():
+    # A MongoClient must not be reused across fork (e.g. gunicorn pre-fork workers): the child drops the parent's
+    # client without closing it, since its sockets and monitor threads belong to the parent, and lazily opens its own.
+    global _client, _client_lock
+
+    _client = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_client_after_fork)
+
+
 def get_db():
     """
     Configuration method to return db instance
@@ -66,7 +133,7 @@ def get_db():
     app_db = getattr(g, "_database", None)
 
     if app_db is None:
-        client = open_connection()
+        client = get_client()
         db_name = get_db_name()
 
         if db_name is None:
@@ -80,41 +147,380 @@ def get_db():
 # Use LocalProxy to read the global db instance with just `db`
 db = LocalProxy(get_db)
 
+# multi-document transactions need a replica set, without one the writes of a transaction run one after the other
+USE_TRANSACTIONS = os.getenv("USE_TRANSACTIONS", "false").lower() == "true"
+
+
+def run_in_transaction(callback):
+    """
+        Run the writes of callback(session) in a single transaction if USE_TRANSACTIONS is enabled, otherwise
+        call it without a session.
+
+        :param callback: The function doing the writes, it must pass the session to every operation.
+        :return: The value returned by callback.
+    """
+    if not USE_TRANSACTIONS:
+        return callback(None)
+
+    with get_client().start_session() as session:
+        return session.with_transaction(callback)
+
+
+def claim_job_run(name: str, interval: int) -> bool:
+    """
+        Claim the current run of a periodic job, so that it runs in a single process when every worker schedules it.
+        The claim is a lease in the jobs collection: the first worker to move next_run forward wins it.
+
+        :param name: The name of the job.
+        :param interval: The seconds between two runs.
+        :return: True if this process won the run.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    try:
+        # a lease not expired yet does not match, and the upsert of an existing _id fails
+        db.jobs.find_one_and_update({"_id": name, "next_run": {"$lte": now}},
+                                    {"$set": {"next_run": now + datetime.timedelta(seconds=interval)}}, upsert=True)
+    except DuplicateKeyError:
+        return False
+
+    return True
+
 default_projection = {"_id": 1, "title": 1, "poster": 1, "release_year": 1, "popularity": 1, "vote_average": 1}
 
-APPROXIMATION_COUNT = 10
-movie_review_count = Singleton()
-movie_added_count = Singleton()
-movie_watched_count = Singleton()
+# "index" serves get_movies from the in-process inverted index, "regex" scans the collection with $regex
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "index")
+movie_search_index = MovieSearchIndex(refresh_interval=get_int_env("SEARCH_REFRESH_INTERVAL", 30),
+                                      rebuild_interval=get_int_env("SEARCH_REBUILD_INTERVAL", 3600))
+search_sort = [("score", -1), ("popularity", -1), ("_id", 1)]
+
+# the first SORT_CACHE_SIZE movies of every sort are kept in memory for SORT_CACHE_TTL seconds (trending, top rated...)
+SORT_CACHE_SIZE = get_int_env("SORT_CACHE_SIZE", 100)
+SORT_CACHE_TTL = get_int_env("SORT_CACHE_TTL", 60)
+_sorted_movies_cache = {}
+
+COUNT_MODES = ("exact", "facet", "cached", "none")
+DEFAULT_COUNT_MODE = os.getenv("DEFAULT_COUNT_MODE", "exact")
+COUNT_CACHE_TTL = get_int_env("COUNT_CACHE_TTL", 60)
+COUNT_CACHE_MAX_ENTRIES = 1024
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+
+# documents fetched per round-trip when a page is streamed instead of loaded in memory
+STREAM_BATCH_SIZE = get_int_env("STREAM_BATCH_SIZE", 500)
+
+# "embedded" keeps the user lists in user.movies_list, "collection" stores one document per entry in the user_movie
+# collection, for lists too large to be embedded (migrate_user_lists.py moves the existing lists)
+USER_LIST_STORAGE = os.getenv("USER_LIST_STORAGE", "embedded")
+USER_LIST_SORTS = {"added": [("added_at", -1)], "title": [("title", 1)]}
+USER_LIST_OPERATIONS = ("add", "update", "remove")
+MAX_USER_LIST_OPERATIONS = get_int_env("MAX_USER_LIST_OPERATIONS", 500)
+
+# number of most recent reviews embedded in the movie document (subset pattern)
+MAX_EMBEDDED_REVIEWS = 5
+
+
+def get_field(document: dict, path: str):
+    """
+        Read a (possibly dotted) field from a document, e.g. "user.username".
+    """
+    for key in path.split("."):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def drop_fields(document: dict, paths: List[str]) -> dict:
+    """
+        Copy a document without some (possibly dotted) fields, dropping the sub-documents left empty.
+    """
+    document = dict(document)
+
+    for path in paths:
+        key, _, rest = path.partition(".")
+        if not rest:
+            document.pop(key, None)
+        elif isinstance(document.get(key), dict):
+            document[key] = drop_fields(document[key], [rest])
+            if not document[key]:
+                del document[key]
 
+    return document
 
-def paginate_query(collection, query_dict, projection, offset: int, limit: int, sort=None):
+
+def encode_cursor(sort: List[Tuple[str, int]], document: dict) -> str:
+    """
+        Build the opaque continuation token pointing right after a document.
+
+        :param sort: The sort of the paginated query, ending with the "_id" tie-breaker.
+        :param document: The last document of the current page.
+        :return: An url-safe token holding the sort fields and the document's values for them.
+    """
+    payload = {"s": [field for field, _ in sort], "v": [get_field(document, field) for field, _ in sort]}
+    raw = json_util.dumps(payload, json_options=json_util.CANONICAL_JSON_OPTIONS)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str, sort: List[Tuple[str, int]]) -> list:
+    """
+        Read the sort key values back from a continuation token.
+
+        :param token: The token returned by encode_cursor.
+        :param sort: The sort of the paginated query, it must be the one the token was built for.
+        :return: The values of the sort fields of the last document of the previous page.
     """
-        Paginate a MongoDB query.
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        payload = json_util.loads(raw, json_options=json_util.CANONICAL_JSON_OPTIONS)
+        fields, values = payload["s"], payload["v"]
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+    if fields != [field for field, _ in sort] or len(values) != len(sort):
+        raise ValueError("The cursor does not belong to this query")
+
+    return values
+
+
+def keyset_filter(sort: List[Tuple[str, int]], values: list) -> dict:
+    """
+        Build the filter matching the documents that come after the given sort key values.
+        For a sort (a, b, _id) this is: a > va OR (a = va AND b > vb) OR (a = va AND b = vb AND _id > vid),
+        with $lt instead of $gt for descending fields.
+
+        MongoDB sorts null and missing values before any other value, but $gt and $lt only compare values of the
+        same type: the null/missing documents are matched explicitly ({field: None} matches both).
+    """
+    or_conditions = []
+
+    for idx, (field, direction) in enumerate(sort):
+        condition = {prev_field: values[prev_idx] for prev_idx, (prev_field, _) in enumerate(sort[:idx])}
+        value = values[idx]
+
+        if value is None:
+            # ascending, every non null value comes after null; descending, nothing does
+            if direction == -1:
+                continue
+            condition[field] = {"$ne": None}
+        elif direction == 1:
+            condition[field] = {"$gt": value}
+        else:
+            # descending, the null/missing values come after all the others
+            condition["$or"] = [{field: {"$lt": value}}, {field: None}]
+
+        or_conditions.append(condition)
+
+    return or_conditions[0] if len(or_conditions) == 1 else {"$or": or_conditions}
+
+
+def get_cached_count(collection, query_dict) -> int:
+    """
+        Count the documents matching a query, reusing a previous count if it is at most COUNT_CACHE_TTL seconds old.
+        The unfiltered count is read from the collection metadata (estimated_document_count).
+    """
+    key = (collection.name, json_util.dumps(query_dict, sort_keys=True))
+    now = time.monotonic()
+
+    with _count_cache_lock:
+        cached = _count_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    total_count = collection.estimated_document_count() if not query_dict else collection.count_documents(query_dict)
+    set_cached_count(collection, query_dict, total_count)
+
+    return total_count
+
+
+def set_cached_count(collection, query_dict, total_count: int):
+    """
+        Store the count of the documents matching a query, e.g. one computed by a $facet, for get_cached_count.
+    """
+    key = (collection.name, json_util.dumps(query_dict, sort_keys=True))
+
+    with _count_cache_lock:
+        if len(_count_cache) >= COUNT_CACHE_MAX_ENTRIES:
+            _count_cache.pop(next(iter(_count_cache)))
+        _count_cache[key] = (time.monotonic() + COUNT_CACHE_TTL, total_count)
+
+
+class StreamedResults:
+    """
+        The documents of a page, read lazily from a MongoDB cursor (or any iterable) while they are iterated.
+        The continuation token of the next page is only known once the whole page has been iterated.
+    """
+
+    def __init__(self, documents: Iterable[dict], limit: int, sort: List[Tuple[str, int]],
+                 hidden: Optional[List[str]] = None):
+        self.documents = documents
+        self.limit = limit
+        self.sort = sort
+        self.hidden = hidden or []
+        self.transform = None
+        self.next_cursor = None
+
+    def map(self, transform: Callable[[dict], dict]) -> "StreamedResults":
+        """
+            Transform every document when it is read, the continuation token is still built on the original one.
+        """
+        self.transform = transform
+        return self
+
+    def __iter__(self):
+        last = None
+
+        try:
+            for idx, document in enumerate(self.documents):
+                # the extra document fetched tells that there is a next page
+                if self.limit and idx == self.limit:
+                    self.next_cursor = encode_cursor(self.sort, last)
+                    break
+
+                last = document
+                # the sort fields only fetched for the token are not returned
+                document = drop_fields(document, self.hidden) if self.hidden else document
+                yield self.transform(document) if self.transform else document
+        finally:
+            if hasattr(self.documents, "close"):
+                self.documents.close()
+
+
+def paginate_query(collection, query_dict, projection, offset: int, limit: int, sort=None, cursor: Optional[str] = None,
+                   count: Optional[str] = None, stream: bool = False):
+    """
+        Paginate a MongoDB query, either by offset or by keyset (continuation token).
 
         :param collection: The collection from which you want to paginate.
         :param query_dict: The MongoDB query.
         :param projection: The fields to include or exclude in the result.
-        :param offset: The number of documents to skip.
+        :param offset: The number of documents to skip, ignored when a cursor is given.
         :param limit: The maximum number of documents to return.
-        :param sort: The sort order for the query.
-        :return: A tuple containing the paginated results and the total count of documents.
+        :param sort: The sort order for the query, as a list of (field, direction). An "_id" tie-breaker is added
+            so that the order is total and a continuation token can be built.
+        :param cursor: The continuation token returned with the previous page.
+        :param count: How the total is computed, one of COUNT_MODES: "exact" runs count_documents next to the find,
+            "facet" gets page and total with a single aggregation (the pages after a cursor are read with find
+            and reuse the total of the first page, like "cached"), "cached" reuses a count at most COUNT_CACHE_TTL
+            seconds old, "none" skips the total. Defaults to DEFAULT_COUNT_MODE.
+        :param stream: Return the results as StreamedResults, read STREAM_BATCH_SIZE documents at a time while they
+            are iterated. The continuation token is then given by the StreamedResults, after the iteration.
+        :return: A tuple containing the paginated results, the total count of documents (None if not counted) and
+            the continuation token for the next page (None when there are no more documents).
     """
-    query = collection.find(query_dict, projection)
+    count = count or DEFAULT_COUNT_MODE
+    if count not in COUNT_MODES:
+        raise ValueError(f"Unknown count mode {count}, expected one of {COUNT_MODES}")
+
+    sort = list(sort or [])
+    if not sort or sort[-1][0] != "_id":
+        sort.append(("_id", sort[-1][1] if sort else 1))
+
+    hidden = []
+    if projection and any(projection.values()):
+        # inclusion projection: the sort fields are needed to build the next cursor, the ones that were not asked
+        # for (neither them nor a parent, _id is included unless excluded) are removed from the results afterwards
+        hidden = [field for field, _ in sort
+                  if not any(projection.get(".".join(field.split(".")[:depth]), field == "_id")
+                             for depth in range(1, field.count(".") + 2))]
+        projection = {**projection, **{field: 1 for field in hidden}}
+
+    after = None
+    if cursor:
+        after = keyset_filter(sort, decode_cursor(cursor, sort))
+        offset = 0
+
+    # one extra document tells whether there is a next page without counting
+    fetch = limit + 1 if limit else 0
+
+    if count == "facet" and not after:
+        items_stages = [{"$skip": offset}] if offset else []
+        items_stages += [{"$limit": fetch}] if fetch else []
+        items_stages += [{"$project": projection}] if projection else []
+
+        # $match and $sort run before $facet so they can still use an index
+        pipeline = [{"$match": query_dict}, {"$sort": dict(sort)},
+                    {"$facet": {"items": items_stages, "total": [{"$count": "count"}]}}]
+        facet = next(collection.aggregate(pipeline))
+        results = facet["items"]
+        total_count = facet["total"][0]["count"] if facet["total"] else 0
+        # the pages after a cursor reuse this total
+        set_cached_count(collection, query_dict, total_count)
+    else:
+        find_filter = query_dict
+        if after:
+            find_filter = {"$and": [query_dict, after]} if query_dict else after
+
+        results = collection.find(find_filter, projection).sort(sort).skip(offset).limit(fetch)
+        results = results.batch_size(STREAM_BATCH_SIZE) if stream else list(results)
+
+        if count == "exact":
+            total_count = collection.count_documents(query_dict)
+        elif count in ["cached", "facet"]:
+            # inside $facet the keyset $match would come after the $sort of the whole query and could not use an
+            # index, so a page after a cursor is read with find and the total counted by the first page is reused
+            total_count = get_cached_count(collection, query_dict)
+        else:
+            total_count = None
+
+    if stream:
+        return StreamedResults(results, limit, sort, hidden), total_count, None
+
+    has_more = bool(fetch) and len(results) > limit
+    results = results[:limit] if has_more else results
+    next_cursor = encode_cursor(sort, results[-1]) if has_more else None
+
+    if hidden:
+        results = [drop_fields(document, hidden) for document in results]
 
-    if sort:
-        query = query.sort(sort)
+    return results, total_count, next_cursor
 
-    total_count = collection.count_documents(query_dict)
-    results = query.skip(offset).limit(limit)
 
-    return list(results), total_count
+def paginate_search(collection, text: str, projection, offset: int, limit: int, cursor: Optional[str] = None,
+                    count: Optional[str] = None):
+    """
+        Paginate the movies matching a text search, best matches first.
+
+        :param collection: The movie collection.
+        :param text: The comma separated terms to search.
+        :param projection: The fields to include or exclude in the result.
+        :param offset: The number of movies to skip, ignored when a cursor is given.
+        :param limit: The maximum number of movies to return.
+        :param cursor: The continuation token returned with the previous page.
+        :param count: "none" to skip the total, which is otherwise always exact since it comes for free.
+        :return: A tuple containing the paginated results, the total count of matching movies and the continuation
+            token for the next page.
+    """
+    ranked = movie_search_index.search(text)
+
+    if cursor:
+        score, popularity, last_id = decode_cursor(cursor, search_sort)
+        # the ranking is sorted by (-score, -popularity, _id), start right after the last movie of the previous page
+        last_key = (-score, -popularity, last_id)
+        offset = bisect_right(ranked, last_key, key=lambda item: (-item[0], -item[1], item[2]))
+
+    page = ranked[offset:offset + limit]
+    has_more = offset + limit < len(ranked)
+
+    if projection and projection.get("_id") == 0:
+        projection = {field: value for field, value in projection.items() if field != "_id"}
+
+    movies = {movie["_id"]: movie for movie in collection.find({"_id": {"$in": [i for _, _, i in page]}}, projection)}
+    results = [movies[movie_id] for _, _, movie_id in page if movie_id in movies]
+
+    next_cursor = None
+    if has_more and page:
+        score, popularity, last_id = page[-1]
+        next_cursor = encode_cursor(search_sort, {"score": score, "popularity": popularity, "_id": last_id})
+
+    return results, None if count == "none" else len(ranked), next_cursor
 
 
 # MOVIES QUERIES -- START
 
-def get_movies(offset: int, items_per_page: int, text: Optional[str] = None, projection: Optional[dict] = None) \
-        -> Union[Tuple[List[dict], int], Exception]:
+def get_movies(offset: int, items_per_page: int, text: Optional[str] = None, projection: Optional[dict] = None,
+               cursor: Optional[str] = None, count: Optional[str] = None, stream: bool = False) \
+        -> Union[Tuple[List[dict], Optional[int], Optional[str]], Exception]:
     """
         Get movies based on title, directors, and actors.
     
@@ -122,11 +528,22 @@ def get_movies(offset: int, items_per_page: int, text: Optional[str] = None, pro
         :param items_per_page: The maximum number of movies to return per page.
         :param text: The field of the movie (title, actors, directors).
         :param projection: The fields to include or exclude in the result.
-        :return: A tuple containing the list of movies for the given page and the total count of movies that match
-            the query criteria or an Exception if an error occurs.
+        :param cursor: The continuation token of the previous page, used instead of the offset.
+        :param count: How the total count is computed, see paginate_query.
+        :param stream: Read the documents while they are iterated, see paginate_query.
+        :return: A tuple containing the list of movies for the given page, the total count of movies that match
+            the query criteria and the continuation token of the next page, or an Exception if an error occurs.
     """
 
     try:
+        projection = projection or default_projection
+
+        if text and SEARCH_BACKEND == "index":
+            movie_search_index.refresh(db.movie)
+            # until the index is first built, the search falls back to the regex query
+            if movie_search_index.ready:
+                return paginate_search(db.movie, text, projection, offset, items_per_page, cursor, count)
+
         query = {}
 
         if text:
@@ -158,17 +575,26 @@ def get_movies(offset: int, items_per_page: int, text: Optional[str] = None, pro
 
             query["$or"] = or_conditions
 
-        projection = projection or default_projection
-
         # Paginate the query
 
-        return paginate_query(db.movie, query, projection, offset, items_per_page)
+        return paginate_query(db.movie, query, projection, offset, items_per_page, cursor=cursor, count=count,
+                              stream=stream)
     except Exception as e:
         return e
 
 
+def start_search_index():
+    """
+        Start building the search index in the background, so that it is ready before the first searches.
+    """
+    if SEARCH_BACKEND == "index":
+        movie_search_index.refresh(db.movie)
+
+
 def get_movies_by_genres(offset: int, items_per_page: int, genres: Union[List[str], str] = None,
-                         projection: Optional[dict] = None) -> Union[Tuple[List[dict], int], Exception]:
+                         projection: Optional[dict] = None, cursor: Optional[str] = None,
+                         count: Optional[str] = None, stream: bool = False) \
+        -> Union[Tuple[List[dict], Optional[int], Optional[str]], Exception]:
     """
         Get movies based on genres with pagination and projection.
     
@@ -176,8 +602,11 @@ def get_movies_by_genres(offset: int, items_per_page: int, genres: Union[List[st
         :param offset: The number of documents to skip.
         :param items_per_page: The maximum number of movies to return per page.
         :param genres: List of genres or a single genre.
-        :return: A tuple containing the list of movies for the given page and the total count of movies that match the criteria,
-                or an Exception if an error occurs.
+        :param cursor: The continuation token of the previous page, used instead of the offset.
+        :param count: How the total count is computed, see paginate_query.
+        :param stream: Read the documents while they are iterated, see paginate_query.
+        :return: A tuple containing the list of movies for the given page, the total count of movies that match the criteria
+                and the continuation token of the next page, or an Exception if an error occurs.
     """
     try:
         query = {"genres": {"$all": genres} if isinstance(genres, list) else genres}
@@ -185,13 +614,16 @@ def get_movies_by_genres(offset: int, items_per_page: int, genres: Union[List[st
         projection = projection or default_projection
 
         # Paginate the query
-        return paginate_query(db.movie, query, projection, offset, items_per_page)
+        return paginate_query(db.movie, query, projection, offset, items_per_page, cursor=cursor, count=count,
+                              stream=stream)
     except Exception as e:
         return e
 
 
 def get_movies_by_release_year(offset: int, items_per_page: int, release_year: int,
-                               projection: Optional[dict] = None) -> Union[Tuple[List[dict], int], Exception]:
+                               projection: Optional[dict] = None, cursor: Optional[str] = None,
+                               count: Optional[str] = None, stream: bool = False) \
+        -> Union[Tuple[List[dict], Optional[int], Optional[str]], Exception]:
     """
         Get movies released in a specific year with pagination and projection.
     
@@ -199,8 +631,11 @@ def get_movies_by_release_year(offset: int, items_per_page: int, release_year: i
         :param offset: The number of documents to skip.
         :param items_per_page: The maximum number of movies to return per page.
         :param release_year: The release year.
-        :return: A tuple containing the list of movies for the given page and the total count of movies that match
-            the criteria or an Exception if an error occurs.
+        :param cursor: The continuation token of the previous page, used instead of the offset.
+        :param count: How the total count is computed, see paginate_query.
+        :param stream: Read the documents while they are iterated, see paginate_query.
+        :return: A tuple containing the list of movies for the given page, the total count of movies that match
+            the criteria and the continuation token of the next page, or an Exception if an error occurs.
     """
     try:
         query = {"release_year": release_year}
@@ -209,57 +644,131 @@ def get_movies_by_release_year(offset: int, items_per_page: int, release_year: i
         projection = projection or default_projection
 
         # Paginate the query
-        return paginate_query(db.movie, query, projection, offset, items_per_page)
+        return paginate_query(db.movie, query, projection, offset, items_per_page, cursor=cursor, count=count,
+                              stream=stream)
     except Exception as e:
         return e
 
 
+def get_top_sorted_movies(field: str, order: int, refresh: bool = False) -> Tuple[List[dict], bool]:
+    """
+        Get the first SORT_CACHE_SIZE movies of a sort, from memory if they were read less than SORT_CACHE_TTL
+        seconds ago.
+
+        :param field: The field to sort by, one of SORTABLE_MOVIE_FIELDS.
+        :param order: 1 for ascending, -1 for descending order.
+        :param refresh: Read the movies from the database even if they are cached.
+        :return: A tuple containing the movies and whether there are more movies after them.
+    """
+    cached = _sorted_movies_cache.get((field, order))
+    if not refresh and cached and cached[0] > time.monotonic():
+        return cached[1], cached[2]
+
+    movies, _, next_cursor = paginate_query(db.movie, {}, default_projection, 0, SORT_CACHE_SIZE, [(field, order)],
+                                            count="none")
+    _sorted_movies_cache[(field, order)] = (time.monotonic() + SORT_CACHE_TTL, movies, next_cursor is not None)
+
+    return movies, next_cursor is not None
+
+
+def refresh_sorted_movies_cache():
+    """
+        Precompute the first page of every sort, in both orders.
+    """
+    for field in SORTABLE_MOVIE_FIELDS:
+        for order in [-1, 1]:
+            get_top_sorted_movies(field, order, refresh=True)
+
+
 def sort_movies(offset: int, items_per_page: int, field: str, order: str = "-1",
-                projection: Optional[dict] = None) -> Union[Tuple[List[dict], int], Exception]:
+                projection: Optional[dict] = None, cursor: Optional[str] = None, count: Optional[str] = None,
+                stream: bool = False) \
+        -> Union[Tuple[List[dict], Optional[int], Optional[str]], Exception]:
     """
-        Get movies sorted in descending order by rating.
+        Get movies sorted by one of the SORTABLE_MOVIE_FIELDS. The pages within the first SORT_CACHE_SIZE movies
+        are served from memory.
     
-        :param order: The order to sort by.
+        :param order: The order to sort by, "1" or "-1".
         :param field: The field to sort by.
         :param projection: The fields to include or exclude in the result.
         :param offset: The number of documents to skip.
         :param items_per_page: The maximum number of movies to return per page.
-        :return: A tuple containing the list of movies for the given page and the total count of movies that match
-            the criteria or an Exception if an error occurs.
+        :param cursor: The continuation token of the previous page, used instead of the offset.
+        :param count: How the total count is computed, see paginate_query.
+        :param stream: Read the documents while they are iterated, see paginate_query.
+        :return: A tuple containing the list of movies for the given page, the total count of movies that match
+            the criteria and the continuation token of the next page, or an Exception if an error occurs.
     """
     try:
+        if field not in SORTABLE_MOVIE_FIELDS:
+            raise ValueError(f"Movies cannot be sorted by {field}")
+        if order not in ["1", "-1"]:
+            raise ValueError(f"Invalid sort order {order}")
+
+        sort = [(field, int(order))]
+        count = count or "cached"
+
+        if not projection and not cursor and count in ["cached", "none"] and \
+                offset + items_per_page <= SORT_CACHE_SIZE:
+            top_movies, more_movies = get_top_sorted_movies(field, int(order))
+            movies = top_movies[offset:offset + items_per_page]
+
+            has_more = offset + items_per_page < len(top_movies) or more_movies
+            next_cursor = encode_cursor(sort + [("_id", int(order))], movies[-1]) if has_more and movies else None
+            total_count = get_cached_count(db.movie, {}) if count == "cached" else None
+
+            return movies, total_count, next_cursor
+
         # Default projection if not provided
         projection = projection or default_projection
 
         # Paginate the query
-        return paginate_query(db.movie, {}, projection, offset, items_per_page, {field: int(order)})
+        return paginate_query(db.movie, {}, projection, offset, items_per_page, sort, cursor, count, stream)
     except Exception as e:
         return e
 
 
-def get_movie_reviews(offset: int, items_per_page: int = None, movie_id: str = None) -> Union[
-    Tuple[List[dict], int], Exception]:
+def get_movie_reviews(offset: int, items_per_page: int = None, movie_id: str = None, projection: Optional[dict] = None,
+                      cursor: Optional[str] = None, count: Optional[str] = None, stream: bool = False) \
+        -> Union[Tuple[List[dict], Optional[int], Optional[str]], Exception]:
     """
         Get a movie's reviews.
     
         :param offset: The number of documents to skip.
         :param items_per_page: The maximum number of movies to return per page.
         :param movie_id: The movie id.
-        :return: A tuple containing the list of reviews for a given movie and the total count of reviews 
-            or an Exception if an error occurs.
+        :param projection: The fields to include or exclude in the result, all of them by default.
+        :param cursor: The continuation token of the previous page, used instead of the offset.
+        :param count: How the total count is computed, see paginate_query.
+        :param stream: Read the documents while they are iterated, see paginate_query.
+        :return: A tuple containing the list of reviews for a given movie, the total count of reviews and the
+            continuation token of the next page, or an Exception if an error occurs.
     """
     try:
         # Construct the MongoDB query with projection
         query = {"movie_id": ObjectId(movie_id)}
 
         # Paginate the query
-        return paginate_query(db.review, query, {}, offset, items_per_page, {"date": -1})
+        return paginate_query(db.review, query, projection or {}, offset, items_per_page, [("date", -1)], cursor,
+                              count, stream)
     except Exception as e:
         return e
 
 
-def get_movie(movie_id: str):
-    return db.movie.find_one({"_id": ObjectId(movie_id)})
+def get_movie(movie_id: str, projection: Optional[dict] = None):
+    return db.movie.find_one({"_id": ObjectId(movie_id)}, projection)
+
+
+def get_movies_by_ids(movie_ids: List[str], projection: dict = None) -> dict:
+    """
+        Get many movies with a single $in query.
+
+        :param movie_ids: The movie ids.
+        :param projection: The fields to return, all of them by default.
+        :return: A dictionary mapping the id (as str) of every existing movie to its document.
+    """
+    movies = db.movie.find({"_id": {"$in": [ObjectId(movie_id) for movie_id in movie_ids]}}, projection)
+    return {str(movie["_id"]): movie for movie in movies}
 
 
 # MOVIES QUERIES -- END
@@ -285,9 +794,112 @@ def apple_sign_in(email, username):
         return new_user
 
 
+def user_list_result(before: Optional[dict], after: Optional[dict]) -> dict:
+    """
+        Build the result of a user list operation.
+
+        :param before: The list entry before the operation, None if it was not in the list.
+        :param after: The list entry after the operation, None if it is not in the list.
+        :return: A dictionary with the entry before and after the operation and the number of modified entries.
+    """
+    return {"modified_count": int(before != after), "before": before, "after": after}
+
+
+def to_list_entry(user_movie: dict) -> dict:
+    """
+        Convert a document of the user_movie collection to the format of the embedded movies_list entries.
+    """
+    return {"_id": user_movie["movie_id"], "title": user_movie.get("title"), "poster": user_movie.get("poster"),
+            "watched": user_movie["watched"], "favourite": user_movie["favourite"],
+            "added_at": user_movie.get("added_at")}
+
+
+def insert_list_entry(user_id: ObjectId, entry: dict, session=None) -> bool:
+    """
+        Add an entry to a user list, unless the movie is already there or the user does not exist.
+
+        :return: True if the entry was added.
+    """
+    if USER_LIST_STORAGE == "collection":
+        # the list of an unknown user is not created, as with the embedded storage
+        if not db.user.find_one({"_id": user_id}, {"_id": 1}, session=session):
+            return False
+
+        # the unique (user_id, movie_id) index makes the upsert a no-op when the movie is already in the list
+        try:
+            result = db.user_movie.update_one(
+                {"user_id": user_id, "movie_id": entry["_id"]},
+                {"$setOnInsert": {key: value for key, value in entry.items() if key != "_id"}},
+                upsert=True, session=session
+            )
+        except DuplicateKeyError:
+            return False
+        return result.upserted_id is not None
+
+    # the $ne guard makes adding a movie already in the list a no-op
+    result = db.user.update_one({"_id": user_id, "movies_list._id": {"$ne": entry["_id"]}},
+                                {"$push": {"movies_list": entry}}, session=session)
+    return result.modified_count > 0
+
+
+def set_list_entry(user_id: ObjectId, movie_id: ObjectId, watched: bool, favourite: bool,
+                   session=None) -> Optional[dict]:
+    """
+        Change the watched and favourite flags of an entry of a user list.
+
+        :return: The entry before the update, None if the movie is not in the list.
+    """
+    if USER_LIST_STORAGE == "collection":
+        user_movie = db.user_movie.find_one_and_update({"user_id": user_id, "movie_id": movie_id},
+                                                       {"$set": {"watched": watched, "favourite": favourite}},
+                                                       return_document=ReturnDocument.BEFORE, session=session)
+        return to_list_entry(user_movie) if user_movie else None
+
+    user = db.user.find_one_and_update(
+        {"_id": user_id, "movies_list._id": movie_id},
+        {"$set": {"movies_list.$.watched": watched, "movies_list.$.favourite": favourite}},
+        {"movies_list": {"$elemMatch": {"_id": movie_id}}},
+        return_document=ReturnDocument.BEFORE,
+        session=session
+    )
+    return user["movies_list"][0] if user else None
+
+
+def remove_list_entry(user_id: ObjectId, movie_id: ObjectId, session=None) -> Optional[dict]:
+    """
+        Remove an entry from a user list.
+
+        :return: The removed entry, None if the movie is not in the list.
+    """
+    if USER_LIST_STORAGE == "collection":
+        user_movie = db.user_movie.find_one_and_delete({"user_id": user_id, "movie_id": movie_id}, session=session)
+        return to_list_entry(user_movie) if user_movie else None
+
+    user = db.user.find_one_and_update(
+        {"_id": user_id, "movies_list._id": movie_id},
+        {"$pull": {"movies_list": {"_id": movie_id}}},
+        {"movies_list": {"$elemMatch": {"_id": movie_id}}},
+        return_document=ReturnDocument.BEFORE,
+        session=session
+    )
+    return user["movies_list"][0] if user else None
+
+
+def update_movie_list_counts(movie_id: ObjectId, added_delta: int, watched_delta: int, session=None):
+    """
+        Apply the change of a user list operation to the movie's added_count and watched_count.
+    """
+    increments = {field: delta for field, delta in [("added_count", added_delta), ("watched_count", watched_delta)]
+                  if delta}
+
+    if increments:
+        db.movie.update_one({"_id": movie_id}, {"$inc": increments}, session=session)
+        movie_cache.delete(get_cache_key(movie_id))
+
+
 def add_movie_to_user_list(user_id: str, movie_id: str, title: str, poster: str, watched: bool, favourite: bool):
     """
-       Add a movie to the user list.
+       Add a movie to the user list, if it is not there yet.
 
        :param user_id: user id.
        :param movie_id: movie id.
@@ -295,21 +907,27 @@ def add_movie_to_user_list(user_id: str, movie_id: str, title: str, poster: str,
        :param poster: movie poster.
        :param watched: if the movie is already watched or to watch.
        :param favourite: if the movie is favourite or not.
-       :return: result of the query
+       :return: result of the operation, see user_list_result
     """
     if favourite:
         watched = True
 
     new_movie = {"_id": ObjectId(movie_id), "title": title, "poster": poster, "watched": watched,
-                 "favourite": favourite}
+                 "favourite": favourite, "added_at": datetime.datetime.now()}
+
+    def write(session):
+        if not insert_list_entry(ObjectId(user_id), new_movie, session):
+            return user_list_result(None, None)
 
-    db.user.update_one({"_id": ObjectId(user_id)}, {"$push": {"movies_list": new_movie}})
+        # the counters are incremented only when the movie was actually added
+        update_movie_list_counts(new_movie["_id"], 1, int(watched), session)
+        return user_list_result(None, new_movie)
+
+    result = run_in_transaction(write)
 
-    # use approximation pattern?
-    result = db.movie.update_one({"_id": ObjectId(movie_id)}, {"$inc": {"added_count": 1}})
     # Check if the update was successful
-    if result.modified_count > 0:
-        print("Successfully incremented the added_count field.")
+    if result["modified_count"] > 0:
+        print("Successfully added the movie to the user's list.")
     else:
         print("No documents were updated.")
 
@@ -323,17 +941,28 @@ def update_movie_in_user_list(user_id: str, movie_id: str, watched: bool, favour
         :param user_id: user id.
         :param movie_id: movie id.
         :param watched: if the movie is already watched or to watch.
-        :return: result of the query
+        :param favourite: if the movie is favourite or not.
+        :return: result of the operation, see user_list_result
     """
     if favourite:
         watched = True
 
-    result = db.user.update_one({"_id": ObjectId(user_id), "movies_list._id": ObjectId(movie_id)},
-                                {"$set": {"movies_list.$.watched": watched, "movies_list.$.favourite": favourite}}
-                                )
+    def write(session):
+        # the entry before the update tells whether the watched_count changes
+        before = set_list_entry(ObjectId(user_id), ObjectId(movie_id), watched, favourite, session)
+
+        if not before:
+            return user_list_result(None, None)
+
+        after = {**before, "watched": watched, "favourite": favourite}
+        update_movie_list_counts(ObjectId(movie_id), 0, int(watched) - int(before["watched"]), session)
+
+        return user_list_result(before, after)
+
+    result = run_in_transaction(write)
 
     # Check if the update was successful
-    if result.modified_count > 0:
+    if result["modified_count"] > 0:
         print("Successfully updated the movie's watched status.")
     else:
         print("No documents were updated.")
@@ -347,14 +976,23 @@ def delete_movie_from_user_list(user_id: str, movie_id: str):
 
         :param user_id: user id.
         :param movie_id: movie id.
-        :return: result of the query
+        :return: result of the operation, see user_list_result
     """
-    result = db.user.update_one({"_id": ObjectId(user_id)},
-                                {"$pull": {"movies_list": {"_id": ObjectId(movie_id)}}}
-                                )
+
+    def write(session):
+        before = remove_list_entry(ObjectId(user_id), ObjectId(movie_id), session)
+
+        if not before:
+            return user_list_result(None, None)
+
+        update_movie_list_counts(ObjectId(movie_id), -1, -int(before["watched"]), session)
+
+        return user_list_result(before, None)
+
+    result = run_in_transaction(write)
 
     # Check if the update was successful
-    if result.modified_count > 0:
+    if result["modified_count"] > 0:
         print("Successfully removed the movie from the user's list.")
     else:
         print("No documents were updated.")
@@ -362,6 +1000,212 @@ def delete_movie_from_user_list(user_id: str, movie_id: str):
     return result
 
 
+def to_bool(value) -> bool:
+    # the client sends the flags either as JSON booleans or as "true"/"false" strings
+    return value.lower() == "true" if isinstance(value, str) else bool(value)
+
+
+def parse_user_list_operation(operation: dict) -> dict:
+    """
+        Validate an operation of a user list batch.
+
+        :param operation: {"op": "add" | "update" | "remove", "movie_id": ..., "title": ..., "poster": ...,
+            "watched": ..., "favourite": ...}, title and poster are needed only to add a movie.
+        :return: The operation with the movie id as ObjectId and the flags as booleans.
+    """
+    if not isinstance(operation, dict) or operation.get("op") not in USER_LIST_OPERATIONS:
+        raise ValueError(f"The operation must be one of {', '.join(USER_LIST_OPERATIONS)}")
+
+    movie_id = operation.get("movie_id")
+    if not isinstance(movie_id, str) or not ObjectId.is_valid(movie_id):
+        raise ValueError("Invalid movie ID format.")
+
+    if operation["op"] == "add" and not (isinstance(operation.get("title"), str) and operation["title"]):
+        raise ValueError("The title is required to add a movie")
+
+    favourite = to_bool(operation.get("favourite", False))
+    watched = favourite or to_bool(operation.get("watched", False))
+
+    return {"op": operation["op"], "movie_id": ObjectId(movie_id), "title": operation.get("title"),
+            "poster": operation.get("poster"), "watched": watched, "favourite": favourite}
+
+
+def get_list_entries(user_id: ObjectId, movie_ids: List[ObjectId], session=None) -> Optional[dict]:
+    """
+        Read some entries of a user list.
+
+        :return: A dictionary mapping the movie ids in the list to their entry, None if the user does not exist.
+    """
+    if USER_LIST_STORAGE == "collection":
+        if db.user.find_one({"_id": user_id}, {"_id": 1}, session=session) is None:
+            return None
+
+        user_movies = db.user_movie.find({"user_id": user_id, "movie_id": {"$in": movie_ids}}, session=session)
+        return {user_movie["movie_id"]: to_list_entry(user_movie) for user_movie in user_movies}
+
+    user = db.user.find_one({"_id": user_id}, {"movies_list": {"$filter": {
+        "input": "$movies_list", "as": "movie", "cond": {"$in": ["$$movie._id", movie_ids]}
+    }}}, session=session)
+    if user is None:
+        return None
+
+    return {entry["_id"]: entry for entry in user.get("movies_list") or []}
+
+
+def list_entry_state(entry: Optional[dict]) -> Optional[Tuple[bool, bool]]:
+    # what the counters depend on: whether the movie is in the list, and its flags
+    return (entry["watched"], entry["favourite"]) if entry else None
+
+
+def user_list_write(user_id: ObjectId, op: str, entry: dict):
+    """
+        Build the bulk write operation applying an add, update or remove to a user list.
+    """
+    movie_id = entry["_id"]
+
+    if USER_LIST_STORAGE == "collection":
+        match = {"user_id": user_id, "movie_id": movie_id}
+        if op == "add":
+            return UpdateOne(match, {"$setOnInsert": {**match, **{key: value for key, value in entry.items()
+                                                                    if key != "_id"}}}, upsert=True)
+        if op == "update":
+            return UpdateOne(match, {"$set": {"watched": entry["watched"], "favourite": entry["favourite"]}})
+        return DeleteOne(match)
+
+    if op == "add":
+        return UpdateOne({"_id": user_id, "movies_list._id": {"$ne": movie_id}}, {"$push": {"movies_list": entry}})
+    if op == "update":
+        return UpdateOne({"_id": user_id, "movies_list._id": movie_id},
+                         {"$set": {"movies_list.$.watched": entry["watched"],
+                                   "movies_list.$.favourite": entry["favourite"]}})
+    return UpdateOne({"_id": user_id, "movies_list._id": movie_id}, {"$pull": {"movies_list": {"_id": movie_id}}})
+
+
+def apply_user_list_operations(user_id: str, operations: List[dict], ordered: bool = True) -> List[dict]:
+    """
+        Apply many add, update and remove operations to a user list, e.g. when the client syncs its offline changes.
+        The list is written with a single bulk write, and so are the added_count/watched_count of the movies.
+
+        :param user_id: user id.
+        :param operations: The operations, see parse_user_list_operation.
+        :param ordered: If True the operations are applied in order and the first failure stops the batch,
+            otherwise all of them are attempted.
+        :return: The result of every operation, in order: {"index", "op", "movie_id", "status"} where status is
+            "applied", "unchanged" (already in the list or same flags), "not_found" (movie not in the list, or no
+            such user), "conflict" (the list was changed by another request meanwhile), "error" or "skipped".
+    """
+    user_id = ObjectId(user_id)
+    results = [{"index": idx, "op": operation.get("op") if isinstance(operation, dict) else None,
+                "movie_id": operation.get("movie_id") if isinstance(operation, dict) else None, "status": "skipped"}
+               for idx, operation in enumerate(operations)]
+    parsed = []
+
+    for idx, operation in enumerate(operations):
+        try:
+            parsed.append((idx, parse_user_list_operation(operation)))
+        except Exception as e:
+            results[idx].update(status="error", error=str(e))
+            # in ordered mode nothing after an invalid operation is applied
+            if ordered:
+                break
+
+    def write(session):
+        movie_ids = list({operation["movie_id"] for _, operation in parsed})
+        entries = get_list_entries(user_id, movie_ids, session)
+
+        if entries is None:
+            for idx, _ in parsed:
+                results[idx]["status"] = "not_found"
+            return
+
+        # replay the operations on the current entries to know what each one changes
+        initial = dict(entries)
+        list_writes = []
+        write_items = []
+
+        for idx, operation in parsed:
+            movie_id = operation["movie_id"]
+            before = entries.get(movie_id)
+
+            if operation["op"] == "add":
+                after = before or {"_id": movie_id, "title": operation["title"], "poster": operation["poster"],
+                                   "watched": operation["watched"], "favourite": operation["favourite"],
+                                   "added_at": datetime.datetime.now()}
+            elif operation["op"] == "update":
+                after = {**before, "watched": operation["watched"], "favourite": operation["favourite"]} \
+                    if before else None
+            else:
+                after = None
+
+            if before is None and after is None:
+                results[idx]["status"] = "not_found"
+            elif before == after:
+                results[idx]["status"] = "unchanged"
+            else:
+                entries[movie_id] = after
+                if after is None:
+                    del entries[movie_id]
+
+                list_writes.append(user_list_write(user_id, operation["op"], after or before))
+                write_items.append((idx, movie_id, after))
+
+        if not list_writes:
+            return
+
+        failed = set()
+        collection = db.user_movie if USER_LIST_STORAGE == "collection" else db.user
+        try:
+            counts = collection.bulk_write(list_writes, ordered=ordered, session=session).bulk_api_result
+        except BulkWriteError as e:
+            counts = e.details
+            for error in e.details["writeErrors"]:
+                failed.add(error["index"])
+                results[write_items[error["index"]][0]]["error"] = error["errmsg"]
+            if ordered:
+                # an ordered bulk write stops at its first error
+                failed.update(range(min(failed), len(list_writes)))
+
+        # the entry of every movie after its last write that did not fail
+        expected = {}
+        for write_idx, (idx, movie_id, after) in enumerate(write_items):
+            if write_idx in failed:
+                results[idx]["status"] = "error" if "error" in results[idx] else "skipped"
+            else:
+                expected[movie_id] = after
+
+        # every write changes the list, so a write that changed nothing found the list changed since it was read
+        # (e.g. by a concurrent request): the entries are then read again instead of trusting the replay
+        changed = counts["nModified"] + counts["nUpserted"] + counts["nRemoved"]
+        final = entries if not failed and changed == len(list_writes) else \
+            get_list_entries(user_id, list(expected), session) or {}
+
+        counter_writes = []
+        for movie_id, after in expected.items():
+            applied = list_entry_state(final.get(movie_id)) == list_entry_state(after)
+
+            for idx, write_movie_id, _ in write_items:
+                if write_movie_id == movie_id and results[idx]["status"] == "skipped":
+                    results[idx]["status"] = "applied" if applied else "conflict"
+
+            # the counters of a conflicting movie are left to the request that changed it
+            before = initial.get(movie_id)
+            increments = {field: delta for field, delta in [
+                ("added_count", int(after is not None) - int(before is not None)),
+                ("watched_count", int(bool(after and after["watched"])) - int(bool(before and before["watched"])))
+            ] if delta}
+            if applied and increments:
+                counter_writes.append(UpdateOne({"_id": movie_id}, {"$inc": increments}))
+
+        if counter_writes:
+            db.movie.bulk_write(counter_writes, ordered=False, session=session)
+            movie_cache.delete(*[get_cache_key(movie_id) for movie_id in expected])
+
+    if parsed:
+        run_in_transaction(write)
+
+    return results
+
+
 def get_movies_user_list(user_id: str, watched: bool, favourite: bool):
     """
         Get all movies in the user list, based on watched boolean.
@@ -374,6 +1218,10 @@ def get_movies_user_list(user_id: str, watched: bool, favourite: bool):
     if not watched:
         favourite = False
 
+    if USER_LIST_STORAGE == "collection":
+        user_movies = db.user_movie.find({"user_id": ObjectId(user_id), "watched": watched, "favourite": favourite})
+        return [to_list_entry(user_movie) for user_movie in user_movies.sort(USER_LIST_SORTS["added"])]
+
     pipeline = [
         {"$match": {"_id": ObjectId(user_id)}},
         {"$project": {
@@ -398,13 +1246,85 @@ def get_movies_user_list(user_id: str, watched: bool, favourite: bool):
     return result[0]["movies_list"] if result else []
 
 
+def get_movies_user_list_page(offset: int, items_per_page: int, user_id: str, watched: bool, favourite: bool,
+                              sort: str = "added", cursor: Optional[str] = None, count: Optional[str] = None,
+                              stream: bool = False) \
+        -> Union[Tuple[List[dict], Optional[int], Optional[str]], Exception]:
+    """
+        Get a page of the movies in the user list, based on watched boolean.
+
+        :param offset: The number of movies to skip.
+        :param items_per_page: The maximum number of movies to return per page.
+        :param user_id: user id.
+        :param watched: if the movie is already watched or to watch.
+        :param favourite: if the movie is favourite or not. Favourite can be true only if watched is true
+        :param sort: "added" for the most recently added movies first, "title" for alphabetical order.
+        :param cursor: The continuation token of the previous page, only with the "collection" storage.
+        :param count: How the total count is computed, see paginate_query.
+        :param stream: Read the documents while they are iterated, see paginate_query.
+        :return: A tuple containing the movies of the page, the total count of movies in the list and the
+            continuation token of the next page, or an Exception if an error occurs.
+    """
+    try:
+        if sort not in USER_LIST_SORTS:
+            raise ValueError(f"The user list can be sorted by {', '.join(USER_LIST_SORTS)}")
+
+        if not watched:
+            favourite = False
+
+        if USER_LIST_STORAGE == "collection":
+            query = {"user_id": ObjectId(user_id), "watched": watched, "favourite": favourite}
+            user_movies, total_count, next_cursor = paginate_query(db.user_movie, query, {}, offset, items_per_page,
+                                                                   USER_LIST_SORTS[sort], cursor, count, stream)
+            if stream:
+                return user_movies.map(to_list_entry), total_count, next_cursor
+            return [to_list_entry(user_movie) for user_movie in user_movies], total_count, next_cursor
+
+        if cursor:
+            raise ValueError("Continuation tokens need USER_LIST_STORAGE=collection, use the page instead")
+
+        # the embedded list has no added_at on old entries: the position in the array is the insertion order
+        position_sort = {"position": -1} if sort == "added" else {"movies_list.title": 1, "position": 1}
+        items_stages = [{"$skip": offset}] if offset else []
+        items_stages += [{"$limit": items_per_page}, {"$replaceRoot": {"newRoot": "$movies_list"}}]
+        pipeline = [
+            {"$match": {"_id": ObjectId(user_id)}},
+            {"$unwind": {"path": "$movies_list", "includeArrayIndex": "position"}},
+            {"$match": {"movies_list.watched": watched, "movies_list.favourite": favourite}},
+            {"$sort": position_sort},
+            {"$facet": {"items": items_stages, "total": [{"$count": "count"}]}}
+        ]
+
+        result = next(db.user.aggregate(pipeline), None)
+        if not result:
+            return [], 0, None
+
+        total_count = result["total"][0]["count"] if result["total"] else 0
+
+        return result["items"], total_count, None
+    except Exception as e:
+        return e
+
+
 # USER QUERIES -- END
 
 # REVIEW QUERIES -- START
 
 def add_review(user_id: str, username: str, movie_id: str, title: str, content: str, date: datetime.datetime,
                vote: float):
-    review = db.review.insert_one({
+    """
+        Add a review and keep it in the movie's most recent reviews (subset pattern).
+
+        :param user_id: The id of the reviewer.
+        :param username: The username of the reviewer.
+        :param movie_id: The movie id.
+        :param title: The title of the review.
+        :param content: The content of the review.
+        :param date: The date of the review.
+        :param vote: The vote given to the movie.
+        :return: The id of the new review.
+    """
+    review_document = {
         "user": {
             "user_id": ObjectId(user_id),
             "username": username
@@ -414,124 +1334,305 @@ def add_review(user_id: str, username: str, movie_id: str, title: str, content:
         "content": content,
         "date": date,
         "vote": vote
-    })
+    }
+    # insert_one adds the generated _id to review_document
+    review = db.review.insert_one(review_document)
 
     if review.inserted_id:
-        # update movie
-        review_document = db.review.find_one({"_id": ObjectId(review.inserted_id)})
-        movie_document = db.movie.find_one({"_id": ObjectId(movie_id)}, {"reviews": 1})
-        movie_reviews = []
+        # push the review into the movie's subset, newest first, and drop the oldest ones in the same atomic update,
+        # which also adds the vote to the running vote sum and count
+        db.movie.update_one({"_id": ObjectId(movie_id)}, {
+            "$push": {"reviews": {
+                "$each": [review_document],
+                "$sort": {"date": -1},
+                "$slice": MAX_EMBEDDED_REVIEWS
+            }},
+            "$inc": {"vote_sum": vote, "vote_count": 1}
+        })
+        update_movie_vote_average(movie_id)
+        movie_cache.delete(get_cache_key(movie_id))
 
-        if movie_document:
-            movie_reviews = movie_document["reviews"]
+    return review.inserted_id
 
-            if len(movie_reviews) > 0:
-                movie_reviews = sorted(movie_reviews, key=lambda x: x["date"])
-                movie_reviews.pop(0)
 
-        movie_reviews.append(review_document)
-        movie_reviews = sorted(movie_reviews, key=lambda x: x["date"], reverse=True)
-        db.movie.update_one({"_id": ObjectId(movie_id)}, {"$set": {"reviews": movie_reviews}})
+def update_review(review_id: str, title: str, content: str, vote: float) -> Optional[dict]:
+    """
+        Update a review and its copy embedded in the movie, if it is one of the most recent reviews.
 
-        if movie_id in movie_review_count:
-            movie_review_count[movie_id] += 1
+        :param review_id: The review id.
+        :param title: The new title of the review.
+        :param content: The new content of the review.
+        :param vote: The new vote given to the movie.
+        :return: The updated review, or None if the review does not exist.
+    """
 
-            if movie_review_count[movie_id] >= 5:
-                update_movie_review_stats(movie_id)
-        else:
-            movie_review_count[movie_id] = 1
+    def write(session):
+        # the review before the update gives the vote delta
+        previous_review = db.review.find_one_and_update(
+            {"_id": ObjectId(review_id)},
+            {
+                "$set": {
+                    "title": title,
+                    "content": content,
+                    "vote": vote
+                }
+            },
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
 
-    return review.inserted_id
+        if not previous_review:
+            return None
+
+        review = {**previous_review, "title": title, "content": content, "vote": vote}
+        vote_delta = vote - previous_review["vote"]
+
+        if vote_delta:
+            # the movie is always written to update the vote sum, the embedded copy only if it is there
+            db.movie.update_one(
+                {"_id": review["movie_id"]},
+                {"$set": {"reviews.$[review].title": title, "reviews.$[review].content": content,
+                          "reviews.$[review].vote": vote},
+                 "$inc": {"vote_sum": vote_delta}},
+                array_filters=[{"review._id": review["_id"]}],
+                session=session
+            )
+            update_movie_vote_average(review["movie_id"], session)
+            movie_cache.delete(get_cache_key(review["movie_id"]))
+        else:
+            # positional update of the embedded copy, the filter matches no movie (and nothing is written) when the
+            # review is not in the movie's most recent reviews
+            result = db.movie.update_one(
+                {"_id": review["movie_id"], "reviews._id": review["_id"]},
+                {"$set": {"reviews.$.title": title, "reviews.$.content": content, "reviews.$.vote": vote}},
+                session=session
+            )
+            if result.matched_count > 0:
+                movie_cache.delete(get_cache_key(review["movie_id"]))
 
+        return review
 
-def update_review(review_id: str, title: str, content: str, vote: float):
-    review = db.review.find_one({"_id": ObjectId(review_id)})
+    review = run_in_transaction(write)
 
     if not review:
-        return False  # Return False if the review does not exist
-
-    # Update the review document in the review collection
-    result = db.review.update_one(
-        {"_id": ObjectId(review_id)},
-        {
-            "$set": {
-                "title": title,
-                "content": content,
-                "vote": vote
-            }
-        }
-    )
+        return None
 
-    if review["movie_id"] in movie_review_count:
-        movie_review_count[review["movie_id"]] += 1
+    return review
 
-        if movie_review_count[review["movie_id"]] >= 5:
-            update_movie_review_stats(review["movie_id"])
-    else:
-        movie_review_count[review["movie_id"]] = 1
 
-    # Find the movie document and update the specific review inside the reviews array
-    movie = db.movie.find_one({"_id": ObjectId(review["movie_id"])}, {"reviews": 1})
-    if movie:
-        movie_reviews = movie.get("reviews", [])
+def update_movie_vote_average(movie_id: str, session=None):
+    """
+        Derive a movie's vote_average from its running vote_sum and vote_count. The pipeline update reads the sums
+        on the server, so it is correct even if other reviews were added in the meantime.
+    """
+    db.movie.update_one({"_id": ObjectId(movie_id)}, [{"$set": {"vote_average": {
+        "$cond": [{"$gt": ["$vote_count", 0]}, {"$round": [{"$divide": ["$vote_sum", "$vote_count"]}, 2]}, 0]
+    }}}], session=session)
 
-        # Find the index of the review in the movie's reviews array
-        review_index = next((index for (index, d) in enumerate(movie_reviews) if d["_id"] == ObjectId(review_id)), None)
 
-        if review_index is not None:
-            # Update the specific review in the reviews array
-            movie_reviews[review_index]["title"] = title
-            movie_reviews[review_index]["content"] = content
-            movie_reviews[review_index]["vote"] = vote
+def reconcile_review_stats(movie_ids: Optional[List[ObjectId]] = None, batch_size: int = 1000):
+    """
+        Re-aggregate the reviews of the movies and correct the vote statistics that drifted from them.
 
-            # Update the movie document with the modified reviews array
-            db.movie.update_one(
-                {"_id": ObjectId(review["movie_id"])},
-                {"$set": {"reviews": movie_reviews}}
-            )
+        The statistics of a batch of movies are read before their reviews are aggregated, and a correction is only
+        written if they did not change in the meantime: a review added concurrently (whose $inc the aggregate may
+        or may not include) is left to the next run instead of being overwritten by a stale aggregate.
 
-    return result.modified_count > 0
+        :param movie_ids: The movies to reconcile, all of them if None.
+        :param batch_size: The number of movies reconciled at a time.
+        :return: The number of corrected movies.
+    """
+    query = {"_id": {"$in": movie_ids}} if movie_ids is not None else {}
+    movies = db.movie.find(query, {"vote_sum": 1, "vote_count": 1, "vote_average": 1}).sort("_id", 1)
+    corrected = 0
+    batch = []
+
+    for movie in movies.batch_size(batch_size):
+        batch.append(movie)
+
+        if len(batch) >= batch_size:
+            corrected += reconcile_review_stats_batch(batch)
+            batch = []
 
-def update_movie_review_stats(movie_id: str):
+    if batch:
+        corrected += reconcile_review_stats_batch(batch)
+
+    if corrected:
+        movie_cache.clear()
+
+    return corrected
+
+
+def reconcile_review_stats_batch(movies: List[dict]) -> int:
+    """
+        Correct the vote statistics of a batch of movies, conditionally on the vote_sum and vote_count read before
+        the aggregation.
+
+        :param movies: The movies with their current vote_sum, vote_count and vote_average.
+        :return: The number of corrected movies.
+    """
     pipeline = [
-        {"$match": {"movie_id": ObjectId(movie_id)}},
-        {"$group": {
-            "_id": "$movie_id",
-            "vote_average": {"$avg": "$vote"},
-            "vote_count": {"$sum": 1}
-        }}
+        {"$match": {"movie_id": {"$in": [movie["_id"] for movie in movies]}}},
+        {"$group": {"_id": "$movie_id", "vote_sum": {"$sum": "$vote"}, "vote_count": {"$sum": 1}}}
     ]
+    stats = {result["_id"]: result for result in db.review.aggregate(pipeline)}
+    updates = []
 
-    result = list(db.review.aggregate(pipeline))
+    for movie in movies:
+        if movie["_id"] not in stats and "vote_count" not in movie:
+            continue  # never rated
 
-    if result:
-        average_vote = result[0]["vote_average"]
-        vote_count = result[0]["vote_count"]
-    else:
-        average_vote = 0  # Handle the case where there are no reviews
-        vote_count = 0
+        # the movies whose reviews were all deleted have no statistics left
+        vote_sum = stats[movie["_id"]]["vote_sum"] if movie["_id"] in stats else 0
+        vote_count = stats[movie["_id"]]["vote_count"] if movie["_id"] in stats else 0
+        vote_average = round(vote_sum / vote_count, 2) if vote_count else 0
 
-    # Update the movie document with the vote count and average vote
-    db.movie.update_one(
-        {"_id": ObjectId(movie_id)},
-        {"$set": {"vote_average": round(average_vote, 2), "vote_count": vote_count}}
-    )
+        # only the movies whose statistics differ are written
+        if (movie.get("vote_sum"), movie.get("vote_count"), movie.get("vote_average")) == \
+                (vote_sum, vote_count, vote_average):
+            continue
+
+        # a None value also matches a missing field
+        updates.append(UpdateOne(
+            {"_id": movie["_id"], "vote_sum": movie.get("vote_sum"), "vote_count": movie.get("vote_count")},
+            {"$set": {"vote_sum": vote_sum, "vote_count": vote_count, "vote_average": vote_average}}
+        ))
+
+    return db.movie.bulk_write(updates, ordered=False).modified_count if updates else 0
+
+
+def backfill_vote_sums(batch_size: int = 1000) -> int:
+    """
+        Compute the running vote_sum of the movies rated before it was maintained (vote_count without vote_sum),
+        from their reviews. It must run before add_review increments the sums, otherwise the first new vote becomes
+        the whole sum: create_app runs it before serving.
+
+        :param batch_size: The number of movies reconciled at a time.
+        :return: The number of updated movies.
+    """
+    movie_ids = [movie["_id"] for movie in db.movie.find({"vote_count": {"$exists": True},
+                                                           "vote_sum": {"$exists": False}}, {"_id": 1})]
+    updated = 0
+
+    for start in range(0, len(movie_ids), batch_size):
+        updated += reconcile_review_stats(movie_ids[start:start + batch_size], batch_size)
 
-    movie_review_count[movie_id] = 0
+    return updated
 
 
 def update_movie_added_count(movie_id: str):
-    result = list(db.user.find({"movies_list._id": ObjectId(movie_id)}))
+    """
+        Recount the users having a movie in their list.
+    """
+    if USER_LIST_STORAGE == "collection":
+        added_count = db.user_movie.count_documents({"movie_id": ObjectId(movie_id)})
+    else:
+        added_count = db.user.count_documents({"movies_list._id": ObjectId(movie_id)})
 
-    db.movie.update_one({"_id": ObjectId(movie_id)}, {"$set": {"added_count": len(result)}})
-    movie_added_count[movie_id] = 0
+    db.movie.update_one({"_id": ObjectId(movie_id)}, {"$set": {"added_count": added_count}})
+    movie_cache.delete(get_cache_key(movie_id))
 
 
 def update_movie_watched_count(movie_id: str):
-    result = list(db.user.find({"movies_list.watched": True}))
+    """
+        Recount the users who watched a movie. $elemMatch requires the id and the flag on the same list entry.
+    """
+    if USER_LIST_STORAGE == "collection":
+        watched_count = db.user_movie.count_documents({"movie_id": ObjectId(movie_id), "watched": True})
+    else:
+        watched_count = db.user.count_documents({"movies_list": {"$elemMatch": {"_id": ObjectId(movie_id),
+                                                                                "watched": True}}})
+
+    db.movie.update_one({"_id": ObjectId(movie_id)}, {"$set": {"watched_count": watched_count}})
+    movie_cache.delete(get_cache_key(movie_id))
+
+
+def reset_movie_list_counts(movie_ids: List[ObjectId]) -> int:
+    """
+        Set added_count and watched_count of movies that are in no user list to 0.
 
-    db.movie.update_one({"_id": ObjectId(movie_id)}, {"$set": {"watched_count": len(result)}})
-    movie_watched_count[movie_id] = 0
+        :return: The number of updated movies.
+    """
+    return db.movie.update_many({"_id": {"$in": movie_ids}},
+                                {"$set": {"added_count": 0, "watched_count": 0}}).modified_count
+
+
+def recompute_movie_list_counts(movie_ids: Optional[List[str]] = None, batch_size: int = 1000) -> int:
+    """
+        Recount added_count and watched_count of many movies with a single aggregation over the user lists, instead
+        of transferring the user documents.
+
+        :param movie_ids: The movies to recount, all of them if None.
+        :param batch_size: The number of movie updates sent in a single bulk write.
+        :return: The number of updated movies.
+    """
+    if movie_ids is not None:
+        movie_ids = [ObjectId(movie_id) for movie_id in movie_ids]
+
+    if USER_LIST_STORAGE == "collection":
+        collection = db.user_movie
+        pipeline = [{"$match": {"movie_id": {"$in": movie_ids}}}] if movie_ids is not None else []
+        pipeline.append({"$group": {
+            "_id": "$movie_id",
+            "added_count": {"$sum": 1},
+            "watched_count": {"$sum": {"$cond": ["$watched", 1, 0]}}
+        }})
+    else:
+        collection = db.user
+        pipeline = []
+        if movie_ids is not None:
+            # uses the multikey index on movies_list._id to read only the users having one of the movies
+            pipeline.append({"$match": {"movies_list._id": {"$in": movie_ids}}})
+
+        pipeline += [{"$project": {"_id": 0, "movies_list._id": 1, "movies_list.watched": 1}},
+                     {"$unwind": "$movies_list"}]
+        if movie_ids is not None:
+            pipeline.append({"$match": {"movies_list._id": {"$in": movie_ids}}})
+        pipeline.append({"$group": {
+            "_id": "$movies_list._id",
+            "added_count": {"$sum": 1},
+            "watched_count": {"$sum": {"$cond": ["$movies_list.watched", 1, 0]}}
+        }})
+
+    updated = 0
+    counted_ids = []
+    updates = []
+
+    for counts in collection.aggregate(pipeline, allowDiskUse=True):
+        counted_ids.append(counts["_id"])
+        updates.append(UpdateOne({"_id": counts["_id"]}, {"$set": {"added_count": counts["added_count"],
+                                                                   "watched_count": counts["watched_count"]}}))
+
+        if len(updates) >= batch_size:
+            updated += db.movie.bulk_write(updates, ordered=False).modified_count
+            updates = []
+
+    if updates:
+        updated += db.movie.bulk_write(updates, ordered=False).modified_count
+
+    # the movies that are in no list do not come out of the aggregation: the ones still counted are reset by batches
+    # of ids, instead of sending every counted id to the server
+    counted_ids = set(counted_ids)
+    stale = {"$or": [{"added_count": {"$ne": 0}}, {"watched_count": {"$ne": 0}}]}
+    if movie_ids is not None:
+        stale["_id"] = {"$in": movie_ids}
+    uncounted_ids = []
+
+    for movie in db.movie.find(stale, {"_id": 1}).batch_size(batch_size):
+        if movie["_id"] not in counted_ids:
+            uncounted_ids.append(movie["_id"])
+
+        if len(uncounted_ids) >= batch_size:
+            updated += reset_movie_list_counts(uncounted_ids)
+            uncounted_ids = []
+
+    if uncounted_ids:
+        updated += reset_movie_list_counts(uncounted_ids)
+
+    if updated:
+        movie_cache.clear()
+
+    return updated
 
 
 # REVIEW QUERIES -- END
@@ -539,7 +1640,7 @@ def update_movie_watched_count(movie_id: str):
 
 # TROUPE QUERIES -- START
 
-def get_troupe(troupe_id: str):
-    return db.troupe.find_one({"_id": ObjectId(troupe_id)})
+def get_troupe(troupe_id: str, projection: Optional[dict] = None):
+    return db.troupe.find_one({"_id": ObjectId(troupe_id)}, projection)
 
 # TROUPE QUERIES -- END
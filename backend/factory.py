@@ -1,14 +1,28 @@
+import atexit
 import json
+import os
+import threading
+import time
 from datetime import datetime
+from typing import Callable
 
 from bson import json_util, ObjectId
 from flask import Flask, render_template
 from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from pymongo.errors import PyMongoError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from api.movies import movies_api
 from api.troupe import troupe_api
 from api.user import user_api
+from db import close_client, get_client, get_db_name, refresh_sorted_movies_cache, reconcile_review_stats, \
+    backfill_vote_sums, start_search_index, recompute_movie_list_counts, claim_job_run
+from indexes import provision_indexes
 
 
 # https://stackoverflow.com/questions/44146087/pass-user-built-json-encoder-into-flasks-jsonify
@@ -29,6 +43,80 @@ class MongoJsonProvider(JSONProvider):
         return json.loads(s, **kwargs)
 
 
+def orjson_default(o):
+    # same conversions as MongoJsonEncoder, the datetimes are passed through to keep their format
+    if isinstance(o, ObjectId):
+        return str(o)
+    if isinstance(o, datetime):
+        return o.strftime("%Y-%m-%d %H:%M:%S")
+    return json_util.default(o, json_util.CANONICAL_JSON_OPTIONS)
+
+
+class OrjsonMongoJsonProvider(MongoJsonProvider):
+    """
+        MongoJsonProvider encoding with orjson. The values are the same, but the output is compact and not ASCII
+        escaped (like orjson, NaN becomes null). Calls with stdlib options, e.g. indent, fall back to json.dumps.
+    """
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=orjson_default, option=self.options).decode()
+
+    def loads(self, s: str | bytes, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # skip the decoding to str of dumps, the response body is bytes anyway
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=orjson_default, option=self.options),
+                                        mimetype="application/json")
+
+
+def create_json_provider(app) -> JSONProvider:
+    """
+        Create the JSON provider selected by JSON_BACKEND in the .env file: "stdlib" (default) or "orjson".
+    """
+    if os.getenv("JSON_BACKEND", "stdlib") == "orjson":
+        if orjson is None:
+            raise ImportError("JSON_BACKEND is orjson but the orjson package is not installed")
+
+        return OrjsonMongoJsonProvider(app)
+
+    return MongoJsonProvider(app)
+
+
+def start_periodic_job(app, name: str, interval: int, job: Callable[[], int], description: str):
+    """
+        Run a job correcting the movies every `interval` seconds, in a background thread. Every worker schedules the
+        job, but each run is claimed by a single one (claim_job_run).
+
+        :param app: The app, whose context the job runs in.
+        :param name: The name of the thread.
+        :param interval: The seconds between two runs.
+        :param job: The function doing the corrections, returning the number of corrected movies.
+        :param description: What the job corrects, for the logs, e.g. "vote statistics".
+    """
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    if not claim_job_run(name, interval):
+                        continue
+                    corrected = job()
+                if corrected:
+                    print(f"Corrected the {description} of {corrected} movies")
+            except PyMongoError as e:
+                print(f"Could not correct the {description}:", e)
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+
+
 def create_app():
     # APP_DIR = os.path.abspath(os.path.dirname(__file__))
     # STATIC_FOLDER = os.path.join(APP_DIR, 'build/static')
@@ -39,7 +127,45 @@ def create_app():
     app.register_blueprint(movies_api)
     app.register_blueprint(user_api)
     app.register_blueprint(troupe_api)
-    app.json = MongoJsonProvider(app)
+    app.json = create_json_provider(app)
+
+    # every request shares the process-wide MongoClient, close it when the worker exits
+    atexit.register(close_client)
+
+    if os.getenv("ENSURE_INDEXES", "true").lower() == "true":
+        try:
+            provision_indexes(getattr(get_client(), get_db_name()))
+        except PyMongoError as e:
+            print("Could not provision the indexes:", e)
+
+    # the movies rated before the running vote sums were maintained need theirs before the first new review
+    try:
+        with app.app_context():
+            backfilled = backfill_vote_sums()
+        if backfilled:
+            print(f"Backfilled the vote sums of {backfilled} movies")
+    except PyMongoError as e:
+        print("Could not backfill the vote sums:", e)
+
+    try:
+        with app.app_context():
+            refresh_sorted_movies_cache()
+    except PyMongoError as e:
+        print("Could not precompute the sorted movies:", e)
+
+    with app.app_context():
+        start_search_index()
+
+    reconcile_interval = int(os.getenv("REVIEW_STATS_RECONCILE_INTERVAL", 3600))
+    if reconcile_interval > 0:
+        start_periodic_job(app, "review-stats-reconciler", reconcile_interval, reconcile_review_stats,
+                           "vote statistics")
+
+    # the added and watched counts are kept exact by the list operations, the recount corrects any drift
+    list_counts_interval = int(os.getenv("LIST_COUNTS_RECOMPUTE_INTERVAL", 86400))
+    if list_counts_interval > 0:
+        start_periodic_job(app, "list-counts-recount", list_counts_interval, recompute_movie_list_counts,
+                           "added and watched counts")
 
     @app.route('/', defaults={'path': ''})
     @app.route('/<path:path>')
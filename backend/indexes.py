@@ -0,0 +1,157 @@
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+# Fields the movies can be sorted by (sort_movies), each one backed by an index
+SORTABLE_MOVIE_FIELDS = ("popularity", "vote_average", "release_year", "release_date", "added_count",
+                         "watched_count", "title")
+
+# Indexes needed by the queries in backend/db.py. The pagination always adds an _id tie-breaker to the sort, so the
+# compound indexes end with _id in the same direction as the sort.
+INDEXES = {
+    "movie": [
+        # get_movies_by_genres: {"genres": {"$all": [...]}} sorted by _id
+        IndexModel([("genres", ASCENDING), ("_id", ASCENDING)], name="genres_id"),
+        # get_movies_by_release_year: {"release_year": year} sorted by _id
+        IndexModel([("release_year", ASCENDING), ("_id", ASCENDING)], name="release_year_id"),
+        # main.py upserts the movies by their TMDB id (the movies created by the app have none)
+        IndexModel([("tmdb_id", ASCENDING)], name="tmdb_id", unique=True,
+                   partialFilterExpression={"tmdb_id": {"$exists": True}}),
+    ] + [
+        # sort_movies: {field: order, "_id": order}, the index is walked backwards for the ascending order
+        IndexModel([(field, DESCENDING), ("_id", DESCENDING)], name=f"sort_{field}_id")
+        for field in SORTABLE_MOVIE_FIELDS
+    ],
+    "review": [
+        # get_movie_reviews: {"movie_id": id} sorted by date, newest first
+        IndexModel([("movie_id", ASCENDING), ("date", DESCENDING), ("_id", DESCENDING)], name="movie_id_date_id"),
+    ],
+    "user": [
+        # apple_sign_in
+        IndexModel([("email", ASCENDING)], name="email"),
+        # update_movie_added_count, update_movie_watched_count and recompute_movie_list_counts
+        IndexModel([("movies_list._id", ASCENDING), ("movies_list.watched", ASCENDING)],
+                   name="movies_list_id_watched"),
+    ],
+    "user_movie": [
+        # one entry per movie in a user list (USER_LIST_STORAGE=collection)
+        IndexModel([("user_id", ASCENDING), ("movie_id", ASCENDING)], name="user_id_movie_id", unique=True),
+        # get_movies_user_list_page, by the most recently added or by title
+        IndexModel([("user_id", ASCENDING), ("watched", ASCENDING), ("favourite", ASCENDING),
+                    ("added_at", DESCENDING), ("_id", DESCENDING)], name="user_list_added"),
+        IndexModel([("user_id", ASCENDING), ("watched", ASCENDING), ("favourite", ASCENDING),
+                    ("title", ASCENDING), ("_id", ASCENDING)], name="user_list_title"),
+        # added_count and watched_count recounts
+        IndexModel([("movie_id", ASCENDING), ("watched", ASCENDING)], name="movie_id_watched"),
+    ],
+    "troupe": [
+        # main.py links movies and troupe by full name, unique so that concurrent upserts cannot duplicate a member
+        IndexModel([("full_name", ASCENDING)], name="full_name", unique=True),
+        # main.py removes the credits of the re-imported movies
+        IndexModel([("movies._id", ASCENDING)], name="movies_id"),
+    ],
+}
+
+# A sample of every query shape of backend/db.py, as (description, collection, filter, sort), checked with explain()
+QUERY_SHAPES = [
+    ("get_movies_by_genres", "movie", {"genres": {"$all": ["Drama", "Comedy"]}}, [("_id", ASCENDING)]),
+    ("get_movies_by_release_year", "movie", {"release_year": 2000}, [("_id", ASCENDING)]),
+    ("get_movie_reviews", "review", {"movie_id": ObjectId()}, [("date", DESCENDING), ("_id", DESCENDING)]),
+    ("apple_sign_in", "user", {"email": "user@example.com"}, None),
+    ("update_movie_added_count", "user", {"movies_list._id": ObjectId()}, None),
+    ("update_movie_watched_count", "user", {"movies_list": {"$elemMatch": {"_id": ObjectId(), "watched": True}}},
+     None),
+    ("get_movies_user_list_page", "user_movie", {"user_id": ObjectId(), "watched": True, "favourite": False},
+     [("added_at", DESCENDING), ("_id", DESCENDING)]),
+] + [
+    (f"sort_movies by {field}", "movie", {}, [(field, DESCENDING), ("_id", DESCENDING)])
+    for field in SORTABLE_MOVIE_FIELDS
+]
+
+
+def ensure_indexes(db) -> dict:
+    """
+        Create the declared indexes that do not exist yet. Existing indexes with the same name and keys are left
+        untouched, so this can run at every startup.
+
+        :param db: The database.
+        :return: A dictionary mapping every collection to the names of its declared indexes that exist.
+    """
+    created = {}
+
+    for collection, indexes in INDEXES.items():
+        created[collection] = []
+
+        # one by one, so that an index that cannot be created does not prevent the others
+        for index in indexes:
+            try:
+                created[collection].extend(db[collection].create_indexes([index]))
+            except OperationFailure as e:
+                # e.g. an index with the same name but different keys or options was created by hand, or duplicate
+                # values prevent a unique index (main.py merges the duplicate troupe members)
+                print(f"Could not create the index {index.document['name']} of {collection}: {e}")
+
+    return created
+
+
+def get_plan_stages(plan) -> list:
+    """
+        Collect the names of all the stages of an explain() plan.
+    """
+    stages = []
+
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(get_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(get_plan_stages(value))
+
+    return stages
+
+
+def find_unindexed_queries(db, query_shapes=None) -> list:
+    """
+        Explain the query shapes and report the ones that scan the whole collection or sort in memory.
+
+        :param db: The database.
+        :param query_shapes: The (description, collection, filter, sort) to check, QUERY_SHAPES by default.
+        :return: A list of (description, stage) for every query whose winning plan has a COLLSCAN or SORT stage.
+    """
+    unindexed = []
+
+    for description, collection, query, sort in query_shapes or QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+
+        stages = get_plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+
+        for stage in ["COLLSCAN", "SORT"]:
+            if stage in stages:
+                unindexed.append((description, stage))
+
+    return unindexed
+
+
+def provision_indexes(db):
+    """
+        Create the declared indexes, then report the queries that would still scan the collection.
+
+        :param db: The database.
+    """
+    for collection, names in ensure_indexes(db).items():
+        print(f"Indexes of {collection}: {', '.join(names)}")
+
+    for description, stage in find_unindexed_queries(db):
+        print(f"WARNING: the query of {description} is not backed by an index ({stage})")
+
+
+if __name__ == "__main__":
+    from utils.connection import open_connection, close_connection, get_db_name
+
+    client = open_connection()
+    provision_indexes(getattr(client, get_db_name()))
+    close_connection(client)
@@ -0,0 +1,73 @@
+import re
+from typing import List, Optional
+
+# The top-level fields of the documents of every collection, the ones a projection can ask for
+FIELDS = {
+    "movie": {"_id", "title", "tagline", "release_date", "release_year", "overview", "runtime", "budget", "revenue",
+              "popularity", "poster", "genres", "production_companies", "production_countries", "spoken_languages",
+              "actors", "directors", "reviews", "vote_average", "vote_sum", "vote_count", "added_count",
+              "watched_count"},
+    "troupe": {"_id", "full_name", "type", "movies", "picture"},
+    "review": {"_id", "user", "movie_id", "title", "content", "date", "vote"},
+}
+
+# Named projections for the client screens, None returns the whole document
+PROFILES = {
+    "movie": {
+        # lists and grids
+        "card": ["title", "poster", "release_year", "popularity", "vote_average"],
+        # the movie page: no production data and no vote_sum
+        "detail": ["title", "tagline", "release_date", "release_year", "overview", "runtime", "poster", "genres",
+                   "popularity", "vote_average", "vote_count", "added_count", "watched_count", "actors",
+                   "directors", "reviews"],
+        "full": None,
+    },
+    "troupe": {
+        "card": ["full_name", "type", "picture"],
+        "detail": ["full_name", "type", "picture", "movies"],
+        "full": None,
+    },
+    "review": {
+        "card": ["user", "title", "vote", "date"],
+        "detail": ["user", "movie_id", "title", "content", "vote", "date"],
+        "full": None,
+    },
+}
+
+MAX_PROJECTION_FIELDS = 30
+
+FIELD_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+
+def get_projection(collection: str, fields: Optional[List[str]] = None, profile: Optional[str] = None) \
+        -> Optional[dict]:
+    """
+        Build the inclusion projection of the fields (or of the named profile) asked by a client.
+
+        :param collection: The collection, a key of FIELDS.
+        :param fields: The fields to return, e.g. ["title", "actors.full_name"]. The _id is always returned.
+        :param profile: The name of a profile of the collection, used when no fields are given.
+        :return: The projection, or None for the whole document.
+        :raise ValueError: If a field or the profile is unknown.
+    """
+    if not fields:
+        if profile is None:
+            return None
+        if profile not in PROFILES[collection]:
+            raise ValueError(f"Unknown profile {profile}, use one of {', '.join(PROFILES[collection])}")
+
+        fields = PROFILES[collection][profile]
+        return {field: 1 for field in fields} if fields is not None else None
+
+    if len(fields) > MAX_PROJECTION_FIELDS:
+        raise ValueError(f"At most {MAX_PROJECTION_FIELDS} fields can be selected")
+
+    for field in fields:
+        if not isinstance(field, str) or not FIELD_PATTERN.match(field) or field.split(".")[0] not in FIELDS[collection]:
+            raise ValueError(f"Unknown field {field}")
+
+    # a field and one of its subfields would make MongoDB reject the projection (path collision)
+    fields = sorted(set(fields))
+    fields = [field for field in fields if not any(field.startswith(other + ".") for other in fields)]
+
+    return {field: 1 for field in fields}
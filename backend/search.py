@@ -0,0 +1,251 @@
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import defaultdict
+from typing import List, Optional, Tuple
+
+from bson.objectid import ObjectId
+
+# the title weighs more than a director, a director more than one of the (many) actors
+FIELD_WEIGHTS = {"title": 10, "directors": 5, "actors": 3}
+
+# an exact token match ranks above a prefix match (type-ahead)
+EXACT_MATCH_BONUS = 2
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+search_projection = {"_id": 1, "title": 1, "popularity": 1, "directors.full_name": 1, "actors.full_name": 1}
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """
+        Split a text into lower case word tokens.
+    """
+    return TOKEN_PATTERN.findall(text.casefold()) if isinstance(text, str) else []
+
+
+def movie_tokens(movie: dict) -> dict:
+    """
+        Collect the tokens of the searchable fields of a movie, with the weight of the field they come from.
+
+        :param movie: The movie document, with at least title, directors.full_name and actors.full_name.
+        :return: A dictionary mapping every token to its weight for the movie.
+    """
+    tokens = defaultdict(int)
+
+    for token in set(tokenize(movie.get("title"))):
+        tokens[token] += FIELD_WEIGHTS["title"]
+
+    for field in ["directors", "actors"]:
+        names = {token for member in movie.get(field) or [] for token in tokenize(member.get("full_name"))}
+        for token in names:
+            tokens[token] += FIELD_WEIGHTS[field]
+
+    return tokens
+
+
+class MovieSearchIndex:
+    """
+        In-process inverted index over the title, directors and actors of the movie collection.
+
+        New movies are picked up incrementally (by _id, every refresh_interval seconds), while a full rebuild every
+        rebuild_interval seconds takes edited and deleted movies into account. The rebuilds run in a background
+        thread, the searches keep using the current index until the new one is swapped in.
+    """
+
+    def __init__(self, refresh_interval: int = 30, rebuild_interval: int = 3600):
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._postings = {}  # token -> {movie id: weight}
+        self._tokens = []  # sorted tokens, for the prefix lookups
+        self._documents = {}  # movie id -> {token: weight}
+        self._popularity = {}  # movie id -> popularity, to rank movies with the same score
+        self._last_id = None
+        self._last_refresh = 0
+        self._last_rebuild = None
+        self._rebuild_started = None
+        self._rebuilding = False
+
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        # The child of a fork (e.g. gunicorn pre-fork workers) does not inherit the rebuild thread: a rebuild running
+        # in the parent would stay "in progress" forever, and the locks may have been copied while held by it.
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._rebuild_started = None
+        self._rebuilding = False
+
+    def __len__(self):
+        return len(self._documents)
+
+    @property
+    def ready(self) -> bool:
+        """
+            Whether the index was built at least once.
+        """
+        return self._last_rebuild is not None
+
+    def add(self, movie: dict):
+        """
+            Index a movie, replacing it if it was already indexed.
+        """
+        with self._lock:
+            self.remove(movie["_id"])
+
+            tokens = movie_tokens(movie)
+            self._documents[movie["_id"]] = tokens
+            self._popularity[movie["_id"]] = movie.get("popularity") or 0
+
+            for token, weight in tokens.items():
+                if token not in self._postings:
+                    self._postings[token] = {}
+                    insort(self._tokens, token)
+                self._postings[token][movie["_id"]] = weight
+
+            if self._last_id is None or movie["_id"] > self._last_id:
+                self._last_id = movie["_id"]
+
+    def remove(self, movie_id: ObjectId):
+        """
+            Remove a movie from the index, if it is there.
+        """
+        with self._lock:
+            tokens = self._documents.pop(movie_id, None)
+            self._popularity.pop(movie_id, None)
+
+            for token in tokens or []:
+                postings = self._postings[token]
+                postings.pop(movie_id, None)
+
+                if not postings:
+                    del self._postings[token]
+                    del self._tokens[bisect_left(self._tokens, token)]
+
+    def rebuild(self, collection):
+        """
+            Build the whole index again from the movie collection, then swap it in.
+        """
+        postings = defaultdict(dict)
+        documents = {}
+        popularity = {}
+        last_id = None
+
+        for movie in collection.find({}, search_projection):
+            tokens = movie_tokens(movie)
+            documents[movie["_id"]] = tokens
+            popularity[movie["_id"]] = movie.get("popularity") or 0
+
+            for token, weight in tokens.items():
+                postings[token][movie["_id"]] = weight
+
+            if last_id is None or movie["_id"] > last_id:
+                last_id = movie["_id"]
+
+        with self._lock:
+            self._postings = dict(postings)
+            self._tokens = sorted(postings)
+            self._documents = documents
+            self._popularity = popularity
+            self._last_id = last_id
+            self._last_rebuild = self._last_refresh = time.monotonic()
+
+    def _rebuild_in_background(self, collection):
+        try:
+            self.rebuild(collection)
+        except Exception as e:
+            print("Could not rebuild the search index:", e)
+        finally:
+            self._rebuilding = False
+
+    def refresh(self, collection, force: bool = False):
+        """
+            Bring the index up to date with the movie collection if the refresh (or rebuild) interval elapsed.
+            It never waits: the rebuild is started in a background thread, and the incremental refresh is skipped
+            while another thread is doing it.
+
+            :param collection: The movie collection.
+            :param force: Refresh even if the interval did not elapse yet.
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+
+        try:
+            now = time.monotonic()
+
+            # a failed first build is retried after refresh_interval seconds
+            retry_interval = self.rebuild_interval if self.ready else self.refresh_interval
+            if not self._rebuilding and (self._rebuild_started is None or
+                                         now - self._rebuild_started >= retry_interval):
+                self._rebuilding = True
+                self._rebuild_started = now
+                threading.Thread(target=self._rebuild_in_background, args=(collection,), name="search-index-rebuild",
+                                 daemon=True).start()
+
+            if not self.ready or (not force and now - self._last_refresh < self.refresh_interval):
+                return
+
+            query = {"_id": {"$gt": self._last_id}} if self._last_id is not None else {}
+            for movie in collection.find(query, search_projection).sort("_id", 1):
+                self.add(movie)
+            self._last_refresh = now
+        finally:
+            self._refresh_lock.release()
+
+    def _match_token(self, token: str) -> dict:
+        # every indexed token starting with the given one matches it, keeping the best weight for each movie
+        matches = {}
+        idx = bisect_left(self._tokens, token)
+
+        while idx < len(self._tokens) and self._tokens[idx].startswith(token):
+            indexed_token = self._tokens[idx]
+            bonus = EXACT_MATCH_BONUS if indexed_token == token else 1
+
+            for movie_id, weight in self._postings[indexed_token].items():
+                if weight * bonus > matches.get(movie_id, 0):
+                    matches[movie_id] = weight * bonus
+            idx += 1
+
+        return matches
+
+    def _match_term(self, term: str) -> dict:
+        # all the tokens of a term must match the same movie, their scores add up
+        scores = None
+
+        for token in tokenize(term):
+            matches = self._match_token(token)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {movie_id: score + matches[movie_id] for movie_id, score in scores.items()
+                          if movie_id in matches}
+            if not scores:
+                return {}
+
+        return scores or {}
+
+    def search(self, text: str) -> List[Tuple[float, float, ObjectId]]:
+        """
+            Search the movies matching any of the comma separated terms of a text, e.g. "nolan, dicaprio".
+            Every word of a term matches as a prefix of a word of the title, of a director or of an actor.
+
+            :param text: The text to search.
+            :return: The matching movies as (score, popularity, movie id), best matches first.
+        """
+        scores = defaultdict(float)
+
+        with self._lock:
+            for term in text.split(","):
+                for movie_id, score in self._match_term(term).items():
+                    scores[movie_id] += score
+
+            ranked = [(score, self._popularity.get(movie_id, 0), movie_id) for movie_id, score in scores.items()]
+
+        ranked.sort(key=lambda item: (-item[0], -item[1], item[2]))
+        return ranked
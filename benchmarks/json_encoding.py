@@ -0,0 +1,100 @@
+"""
+Compare the stdlib and the orjson JSON providers of the backend on movie documents shaped like the ones of the
+database (ObjectIds, review dates, cast lists), as returned by the list and the detail endpoints.
+
+Run from the repository root: python benchmarks/json_encoding.py [--movies 20] [--repeat 2000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from factory import MongoJsonProvider, OrjsonMongoJsonProvider, orjson  # noqa: E402
+
+WORDS = ["the", "night", "city", "last", "love", "war", "dark", "story", "man", "house", "road", "world", "dream"]
+
+
+def sentence(words: int) -> str:
+    return " ".join(random.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def fake_movie(reviews: int = 5, actors: int = 20) -> dict:
+    movie_id = ObjectId()
+    release_date = datetime(random.randint(1995, 2024), random.randint(1, 12), random.randint(1, 28))
+
+    return {
+        "_id": movie_id,
+        "title": sentence(3),
+        "tagline": sentence(8),
+        "release_date": release_date.isoformat(),
+        "release_year": release_date.year,
+        "overview": sentence(60),
+        "runtime": random.randint(80, 180),
+        "budget": random.randint(0, 200_000_000),
+        "revenue": random.randint(0, 900_000_000),
+        "popularity": random.uniform(0, 500),
+        "poster": f"https://m.media-amazon.com/images/M/{movie_id}.jpg",
+        "genres": random.sample(["Drama", "Comedy", "Action", "Thriller", "Horror", "Romance"], 2),
+        "production_companies": [sentence(2) for _ in range(3)],
+        "production_countries": ["United States of America"],
+        "spoken_languages": ["English", "Italian"],
+        "actors": [{"_id": ObjectId(), "full_name": sentence(2)} for _ in range(actors)],
+        "directors": [{"_id": ObjectId(), "full_name": sentence(2)}],
+        "reviews": [{
+            "_id": ObjectId(),
+            "user": {"user_id": ObjectId(), "username": sentence(1)},
+            "movie_id": movie_id,
+            "title": sentence(4),
+            "content": sentence(40),
+            "date": datetime.now() - timedelta(days=random.randint(0, 1000), seconds=random.randint(0, 86400)),
+            "vote": random.randint(1, 10),
+        } for _ in range(reviews)],
+        "vote_average": random.uniform(1, 10),
+        "vote_sum": random.randint(0, 1000),
+        "vote_count": random.randint(0, 100),
+        "added_count": random.randint(0, 1000),
+        "watched_count": random.randint(0, 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the JSON providers of the backend")
+    parser.add_argument("--movies", type=int, default=20, help="movies of the list response")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    if orjson is None:
+        raise ImportError("the orjson package is not installed")
+
+    random.seed(0)
+    app = Flask(__name__)
+    providers = {"stdlib": MongoJsonProvider(app), "orjson": OrjsonMongoJsonProvider(app)}
+    payloads = {
+        "detail": fake_movie(),
+        "list": {"items": [fake_movie() for _ in range(args.movies)], "page": 0, "next_cursor": None},
+    }
+
+    for name, payload in payloads.items():
+        # the two providers must encode the same values
+        outputs = {backend: provider.dumps(payload) for backend, provider in providers.items()}
+        assert json.loads(outputs["stdlib"]) == json.loads(outputs["orjson"]), f"different {name} output"
+
+        timings = {backend: timeit.timeit(lambda: provider.dumps(payload), number=args.repeat)
+                   for backend, provider in providers.items()}
+
+        print(f"{name} response ({len(outputs['stdlib'])} bytes with stdlib, {len(outputs['orjson'])} with orjson)")
+        for backend, seconds in timings.items():
+            print(f"  {backend:>6}: {seconds / args.repeat * 1e6:9.1f} us per response")
+        print(f"  speed-up: {timings['stdlib'] / timings['orjson']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Compare the conversion of the dataset to movie and troupe documents done by main.get_movies_and_troupe with the
+previous row by row loop (iterrows), and check that both build the same documents.
+
+Run from the repository root: python benchmarks/movie_conversion.py [--csv TMDB_all_movies.csv] [--rows 20000]
+Without --csv the rows are generated, shaped like the preprocessed TMDB dataset.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import get_movies_and_troupe, pre_process_data, TROUPE_PICTURE  # noqa: E402
+from utils.posters import PLACEHOLDER_POSTER  # noqa: E402
+
+NAMES = [f"{first} {last}" for first in ["Anna", "Marco", "John", "Sofia", "Luca", "Emma", "Paul", "Giulia"]
+         for last in ["Rossi", "Smith", "Bianchi", "Brown", "Ferrari", "Jones", "Russo", "Taylor"]]
+
+
+def get_movies_and_troupe_iterrows(data, posters: dict) -> tuple[list, list]:
+    # the conversion main.py used to do, one pandas row at a time
+    movies = []
+    troupe = {}
+
+    for idx, movieRow in data.iterrows():
+        movie = {}
+
+        movie["title"] = movieRow["title"]
+        movie["tagline"] = movieRow["tagline"]
+        movie["release_date"] = datetime.strptime(movieRow["release_date"], "%Y-%m-%d").isoformat()
+        movie["release_year"] = movieRow["release_year"]
+        movie["overview"] = movieRow["overview"]
+        movie["runtime"] = movieRow["runtime"]
+        movie["budget"] = movieRow["budget"]
+        movie["revenue"] = movieRow["revenue"]
+        movie["popularity"] = movieRow["popularity"]
+        movie["poster"] = posters.get(movieRow["imdb_id"], PLACEHOLDER_POSTER)
+        movie["genres"] = movieRow["genres"].split(", ")
+        movie["production_companies"] = movieRow["production_companies"].split(", ")
+        movie["production_countries"] = movieRow["production_countries"].split(", ")
+        movie["spoken_languages"] = movieRow["spoken_languages"].split(", ")
+
+        for column in ["cast", "director"]:
+            members = []
+
+            for member in movieRow[column].split(", "):
+                members.append({"full_name": member})
+                troupe_movie = {
+                    "title": movieRow["title"],
+                    "poster": movie["poster"],
+                    "release_year": movieRow["release_year"],
+                }
+                if member not in troupe:
+                    troupe[member] = {"type": "actor" if column == "cast" else "director", "movies": [troupe_movie]}
+                else:
+                    troupe[member]["movies"].append(troupe_movie)
+
+            movie["actors" if column == "cast" else "directors"] = members
+
+        movie["reviews"] = []
+        movie["watched_count"] = 0
+        movie["added_count"] = 0
+
+        movies.append(movie)
+
+    troupe_data = [{"full_name": full_name, "type": data["type"], "movies": data["movies"], "picture": TROUPE_PICTURE}
+                   for full_name, data in troupe.items()]
+
+    return movies, troupe_data
+
+
+def fake_data(rows: int) -> pd.DataFrame:
+    random.seed(0)
+    release_dates = [f"{random.randint(1995, 2024)}-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}"
+                     for _ in range(rows)]
+
+    return pd.DataFrame({
+        "id": range(rows),
+        "imdb_id": [f"tt{idx:07d}" for idx in range(rows)],
+        "title": [f"Movie {idx}" for idx in range(rows)],
+        "tagline": ["A tagline"] * rows,
+        "release_date": release_dates,
+        "release_year": [int(date[:4]) for date in release_dates],
+        "overview": ["An overview of the movie"] * rows,
+        "runtime": [float(random.randint(80, 180)) for _ in range(rows)],
+        "budget": [float(random.randint(0, 10 ** 8)) for _ in range(rows)],
+        "revenue": [float(random.randint(0, 10 ** 9)) for _ in range(rows)],
+        "popularity": [random.uniform(0, 100) for _ in range(rows)],
+        "genres": [", ".join(random.sample(["Drama", "Comedy", "Action", "Horror"], 2)) for _ in range(rows)],
+        "production_companies": ["Company A, Company B"] * rows,
+        "production_countries": ["United States of America"] * rows,
+        "spoken_languages": ["English, Italian"] * rows,
+        "cast": [", ".join(random.sample(NAMES, 8)) for _ in range(rows)],
+        "director": [random.choice(NAMES) for _ in range(rows)],
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the conversion of the dataset to documents")
+    parser.add_argument("--csv", help="the TMDB dataset, preprocessed like main.py does")
+    parser.add_argument("--rows", type=int, default=20000)
+    args = parser.parse_args()
+
+    data = pre_process_data(args.csv) if args.csv else fake_data(args.rows)
+    data = data.head(args.rows)
+    posters = {imdb_id: f"https://posters.example/{imdb_id}.jpg" for imdb_id in data["imdb_id"].tolist()[::2]}
+
+    timings = {}
+    results = {}
+    for name, convert in [("iterrows", get_movies_and_troupe_iterrows), ("vectorized", get_movies_and_troupe)]:
+        start = time.perf_counter()
+        results[name] = convert(data, posters)
+        timings[name] = time.perf_counter() - start
+
+    # repr also compares the order of the fields and the types of the values
+    assert repr(results["iterrows"]) == repr(results["vectorized"]), "the two conversions built different documents"
+
+    movies, troupe_data = results["vectorized"]
+    print(f"{len(movies)} movies, {len(troupe_data)} troupe members")
+    for name, seconds in timings.items():
+        print(f"  {name:>10}: {seconds:8.3f} s")
+    print(f"  speed-up: {timings['iterrows'] / timings['vectorized']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,119 +1,169 @@
+import argparse
+import os
+import time
 from collections import defaultdict
-from datetime import datetime
+from typing import Iterable, Iterator
 
 import pandas as pd
-from tqdm.notebook import tqdm
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
-from utils.apis import get_movie_cover
+from backend.indexes import INDEXES, provision_indexes
+from utils.checkpoints import IngestionCheckpoint, get_source_id
 from utils.connection import open_connection, close_connection, get_db_name
 from utils.fakes import generate_user, generate_reviews
+from utils.pipeline import ThroughputCounters, run_pipeline
+from utils.posters import create_poster_resolver, PLACEHOLDER_POSTER
 
+# number of movies loaded from the dataset, 0 for all of them
+MAX_MOVIES = int(os.getenv("MAX_MOVIES", 100))
+# rows of the dataset read, converted and inserted at a time, 0 to read the whole file at once
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", 10000))
+# number of movies the fake users and reviews are generated from
+FAKE_DATA_MOVIES = int(os.getenv("FAKE_DATA_MOVIES", 10000))
+# number of updates sent with a single bulk write
+BULK_WRITE_BATCH_SIZE = int(os.getenv("BULK_WRITE_BATCH_SIZE", 1000))
 
-def get_movies_and_troupe(data) -> tuple[list, list]:
-    movies = []
-    troupe = {}
-
-    # Convert the DataFrame rows to a list of tuples
-    data_list = list(data.iterrows())
-
-    for idx, movieRow in tqdm(data_list, desc="Collecting movie entries...", total=len(data_list)):
-        movie = {}
-        if idx == 100:
-            break
-
-        movie["title"] = movieRow["title"]
-        movie["tagline"] = movieRow["tagline"]
-        movie["release_date"] = datetime.strptime(movieRow["release_date"], "%Y-%m-%d").isoformat()
-        movie["release_year"] = movieRow["release_year"]
-        movie["overview"] = movieRow["overview"]
-        movie["runtime"] = movieRow["runtime"]
-        movie["budget"] = movieRow["budget"]
-        movie["revenue"] = movieRow["revenue"]
-        movie["popularity"] = movieRow["popularity"]
-        movie["poster"] = get_movie_cover(imdb_id=movieRow["imdb_id"])
-        movie["genres"] = movieRow["genres"].split(", ")
-        movie["production_companies"] = movieRow["production_companies"].split(", ")
-        movie["production_countries"] = movieRow["production_countries"].split(", ")
-        movie["spoken_languages"] = movieRow["spoken_languages"].split(", ")
-
-        for column in ["cast", "director"]:
-            members = []
-
-            for member in movieRow[column].split(", "):
-                members.append({
-                    "full_name": member,
-                })
-                troupe_movie = {
-                    "title": movieRow["title"],
-                    "poster": movie["poster"],
-                    "release_year": movieRow["release_year"],
-                }
-                if member not in troupe:
-                    troupe[member] = {
-                        "type": "actor" if column == "cast" else "director",
-                        "movies": [troupe_movie]}
-                else:
-                    troupe[member]["movies"].append(troupe_movie)
-
-            movie["actors" if column == "cast" else "directors"] = members
-
-        # add the reviews field --> SUBSET PATTERN
-        movie["reviews"] = []
-        movie["watched_count"] = 0
-        movie["added_count"] = 0
+# pipeline mode (--workers): the chunks are converted by INGEST_WORKERS processes and written by INGEST_WRITERS
+# threads, at most INGEST_QUEUE_SIZE converted chunks wait to be written
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 0))
+INGEST_WRITERS = int(os.getenv("INGEST_WRITERS", 2))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 4))
 
-        movies.append(movie)
+DUPLICATE_KEY_ERROR = 11000
 
-    troupe_data = []
+# the fields of a movie updated by the app, only set when the movie is first inserted
+MOVIE_STATS_FIELDS = ("reviews", "watched_count", "added_count")
 
-    for full_name, data in troupe.items():
-        troupe_data.append({
-            "full_name": full_name,
-            "type": data["type"],
-            "movies": data["movies"],
-            "picture": "https://media-cldnry.s-nbcnews.com/image/upload/t_fit-760w,f_auto,q_auto:best/rockcms/2023-09/kevin-james-king-of-queens-zz-230927-368fe6.jpg"
-        })
+# the columns of the dataset used by the documents, the others (writers, producers...) are not even parsed
+MOVIE_COLUMNS = {
+    "id": "Int64", "imdb_id": object, "title": object, "tagline": object, "release_date": object,
+    "overview": object, "runtime": "float64", "budget": "float64", "revenue": "float64", "popularity": "float64",
+    "genres": object, "production_companies": object, "production_countries": object, "spoken_languages": object,
+    "cast": object, "director": object,
+}
 
-    return movies, troupe_data
+TROUPE_PICTURE = "https://media-cldnry.s-nbcnews.com/image/upload/t_fit-760w,f_auto,q_auto:best/rockcms/2023-09/kevin-james-king-of-queens-zz-230927-368fe6.jpg"
 
 
-def update_coll_with_ids(data, ids):
+def get_movies_and_troupe(data, posters: dict) -> tuple[list, list]:
     """
-    This function updates a list of data dictionaries with the ObjectIds generated by MongoDB after insertion.
+    This function converts the preprocessed dataset to the movie and troupe documents. The columns are converted
+    at once (dates, comma separated lists), and the troupe is grouped by full name from the exploded cast and
+    director columns.
 
     Args:
-        data: The list of data dictionaries.
-        ids: The InsertManyResult object containing the inserted document IDs.
+        data: The preprocessed DataFrame.
+        posters: A dictionary mapping the imdb_id of the movies to their poster url.
 
     Returns:
-        The updated list of data dictionaries with the '_id' field added.
+        The movie documents, in the order of the rows, and the troupe documents, in order of first appearance.
     """
-    for d, inserted_id in zip(data, ids.inserted_ids):
-        d["_id"] = inserted_id  # Directly assign ObjectId to movie
-    return data
+    # tolist() gives the same Python values the rows of the DataFrame used to hold
+    titles = data["title"].tolist()
+    release_years = data["release_year"].tolist()
+    movie_posters = [posters.get(imdb_id, PLACEHOLDER_POSTER) for imdb_id in data["imdb_id"].tolist()]
+    release_dates = pd.to_datetime(data["release_date"], format="%Y-%m-%d").dt.strftime("%Y-%m-%dT%H:%M:%S").tolist()
+    columns = {column: data[column].tolist() for column in ["tagline", "overview", "runtime", "budget", "revenue",
+                                                            "popularity"]}
+    lists = {column: data[column].str.split(", ").tolist() for column in ["genres", "production_companies",
+                                                                          "production_countries", "spoken_languages",
+                                                                          "cast", "director"]}
+
+    movies = [{
+        "title": titles[idx],
+        "tagline": columns["tagline"][idx],
+        "release_date": release_dates[idx],
+        "release_year": release_years[idx],
+        "overview": columns["overview"][idx],
+        "runtime": columns["runtime"][idx],
+        "budget": columns["budget"][idx],
+        "revenue": columns["revenue"][idx],
+        "popularity": columns["popularity"][idx],
+        "poster": movie_posters[idx],
+        "genres": lists["genres"][idx],
+        "production_companies": lists["production_companies"][idx],
+        "production_countries": lists["production_countries"][idx],
+        "spoken_languages": lists["spoken_languages"][idx],
+        "actors": [{"full_name": member} for member in lists["cast"][idx]],
+        "directors": [{"full_name": member} for member in lists["director"][idx]],
+        # add the reviews field --> SUBSET PATTERN
+        "reviews": [],
+        "watched_count": 0,
+        "added_count": 0,
+    } for idx in range(len(titles))]
+
+    # one row per credit, indexed by the position of the movie: the actors of a movie come before its directors
+    credits = pd.concat([
+        pd.DataFrame({"full_name": pd.Series(lists["cast"], dtype=object).explode(), "type": "actor"}),
+        pd.DataFrame({"full_name": pd.Series(lists["director"], dtype=object).explode(), "type": "director"}),
+    ]).sort_index(kind="stable")
+    credits["movie"] = credits.index
+
+    # a member keeps the type of their first credit and lists the movies of all of them
+    troupe = credits.groupby("full_name", sort=False).agg(type=("type", "first"), movies=("movie", list))
+
+    troupe_data = [{
+        "full_name": full_name,
+        "type": type_,
+        "movies": [{"title": titles[movie], "poster": movie_posters[movie], "release_year": release_years[movie]}
+                   for movie in movie_positions],
+        "picture": TROUPE_PICTURE
+    } for full_name, type_, movie_positions in zip(troupe.index.tolist(), troupe["type"].tolist(),
+                                                   troupe["movies"].tolist())]
+
+    return movies, troupe_data
 
 
-def pre_process_data(data_path: str) -> pd.DataFrame:
-    # read the data from the csv file
-    data = pd.read_csv(data_path)
+def clean_movies(data: pd.DataFrame, seen_ids: set) -> pd.DataFrame:
+    """
+    This function cleans a chunk of the dataset: the movies already seen in a previous chunk and the duplicates are
+    dropped, as well as the rows with NA values and the movies not released in the last 30 years.
+
+    Args:
+        data: The rows read from the csv file.
+        seen_ids: The ids of the movies of the previous chunks, updated with the ones of this chunk.
 
-    # drop the duplicates
+    Returns:
+        The preprocessed rows, with the release_year column.
+    """
+    # drop the duplicates, within the chunk and with the previous ones
     data = data.drop_duplicates(subset=["id"])
-    data = data.drop(columns=["writers", "producers", "music_composer", "director_of_photography"])
+    data = data.loc[~data["id"].isin(seen_ids)]
+    seen_ids.update(data["id"].dropna().tolist())
     # remove rows with NA values
     clean_data = data.dropna()
-    # add release_year
-    clean_data.loc[:, 'release_year'] = clean_data['release_date'].str.slice(0, 4)
-    # convert 'release_year' to numeric type if needed
-    clean_data.loc[:, 'release_year'] = pd.to_numeric(clean_data['release_year'], errors='coerce', downcast='integer')
+    # add release_year, as a number
+    release_year = pd.to_numeric(clean_data['release_date'].str.slice(0, 4), errors='coerce')
+    clean_data = clean_data.assign(release_year=release_year)
     # consider only the movies released in the last 30 years
     clean_data = clean_data.loc[(clean_data['release_year'] >= 1995) & (clean_data['release_year'] <= 2025)]
+    clean_data = clean_data.astype({'release_year': 'int64'})
     clean_data.reset_index(drop=True, inplace=True)
 
-    # return the preprocessed data
     return clean_data
 
 
+def read_movie_chunks(data_path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    This function reads the csv file chunk_size rows at a time, only the columns used by the documents, and yields
+    every chunk once preprocessed.
+    """
+    seen_ids = set()
+
+    for chunk in pd.read_csv(data_path, usecols=list(MOVIE_COLUMNS), dtype=MOVIE_COLUMNS, chunksize=chunk_size):
+        yield clean_movies(chunk, seen_ids)
+
+
+def pre_process_data(data_path: str) -> pd.DataFrame:
+    # read the data from the csv file, all at once
+    data = pd.read_csv(data_path, usecols=list(MOVIE_COLUMNS), dtype=MOVIE_COLUMNS)
+
+    # return the preprocessed data
+    return clean_movies(data, set())
+
+
 def update_troup_data_with_movie_ids(troupe_data, movies):
     # Create a lookup dictionary from the first list for quick access
     lookup = {(movie['title'], movie['release_year']): movie['_id'] for movie in movies}
@@ -128,7 +178,313 @@ def update_troup_data_with_movie_ids(troupe_data, movies):
     return troupe_data
 
 
+def bulk_write_batches(collection, requests: Iterable, batch_size: int = BULK_WRITE_BATCH_SIZE) -> int:
+    """
+    This function sends write operations with unordered bulk writes of at most batch_size operations.
+
+    Args:
+        collection: The collection.
+        requests: The write operations, e.g. UpdateOne.
+        batch_size: The maximum number of operations of a bulk write.
+
+    Returns:
+        The number of documents inserted by the upserts.
+    """
+    upserted = 0
+    batch = []
+
+    for request in requests:
+        batch.append(request)
+        if len(batch) >= batch_size:
+            upserted += bulk_write(collection, batch)
+            batch = []
+
+    if batch:
+        upserted += bulk_write(collection, batch)
+
+    return upserted
+
+
+def bulk_write(collection, batch: list) -> int:
+    """
+    This function sends an unordered bulk write, retrying once the upserts that failed on a unique index: two
+    writers upserted the same key at the same time, and the retry matches the document inserted by the other one.
+
+    Returns:
+        The number of documents inserted by the upserts.
+    """
+    try:
+        return collection.bulk_write(batch, ordered=False).upserted_count
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+
+        retried = [batch[error["index"]] for error in errors]
+        return e.details["nUpserted"] + collection.bulk_write(retried, ordered=False).upserted_count
+
+
+def set_troupe_references(movies: list, troupe_coll):
+    """
+    This function replaces the names of the actors and directors of the movies with the reference to their troupe
+    document (_id, full_name, picture), read with a single query, so that the movies are inserted in final form.
+    """
+    names = list({member["full_name"] for movie in movies for field in ["actors", "directors"]
+                  for member in movie[field]})
+    references = {troupe["full_name"]: {"_id": troupe["_id"], "full_name": troupe["full_name"],
+                                        "picture": troupe["picture"]}
+                  for troupe in troupe_coll.find({"full_name": {"$in": names}}, {"full_name": 1, "picture": 1})}
+
+    for movie in movies:
+        for field in ["actors", "directors"]:
+            movie[field] = [references.get(member["full_name"], member) for member in movie[field]]
+
+
+def merge_duplicate_troupe(troupe_coll, movie_coll) -> int:
+    """
+    This function merges the troupe members sharing a full name (inserted again by every run of the previous versions)
+    into the oldest one, so that the unique full_name index can be created: their credits are moved to the kept member
+    and the references of the movies are pointed to it.
+    """
+    duplicates = troupe_coll.aggregate([
+        {"$group": {"_id": "$full_name", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+    merged = 0
+
+    for duplicate in duplicates:
+        kept_id, *duplicate_ids = sorted(duplicate["ids"])
+        credits = [movie for member in troupe_coll.find({"_id": {"$in": duplicate_ids}}, {"movies": 1})
+                   for movie in member.get("movies", [])]
+
+        # the same credit imported by several runs is kept once
+        troupe_coll.update_one({"_id": kept_id}, {"$addToSet": {"movies": {"$each": credits}}})
+        for field in ["actors", "directors"]:
+            movie_coll.update_many({f"{field}._id": {"$in": duplicate_ids}},
+                                   {"$set": {f"{field}.$[member]._id": kept_id}},
+                                   array_filters=[{"member._id": {"$in": duplicate_ids}}])
+        troupe_coll.delete_many({"_id": {"$in": duplicate_ids}})
+        merged += len(duplicate_ids)
+
+    return merged
+
+
+def get_movie_stats_updates(movies: list, reviews: list) -> Iterator[UpdateOne]:
+    """
+    This function computes the statistics of the movies the fake data was generated for (added and watched counts,
+    votes and most recent reviews) and yields a single update per changed movie.
+    """
+    votes = defaultdict(lambda: [0, 0])
+    for review in reviews:
+        votes[review["movie_id"]][0] += review["vote"]
+        votes[review["movie_id"]][1] += 1
+
+    for movie in movies:
+        fields = {}
+
+        if movie["added_count"] or movie["watched_count"]:
+            fields["added_count"] = movie["added_count"]
+            fields["watched_count"] = movie["watched_count"]
+
+        if movie["_id"] in votes:
+            vote_sum, vote_count = votes[movie["_id"]]
+            fields["vote_average"] = round(vote_sum / vote_count, 2)
+            fields["vote_sum"] = vote_sum  # kept up to date by the backend
+            fields["vote_count"] = vote_count
+
+        if movie["reviews"]:
+            fields["reviews"] = movie["reviews"]
+
+        if fields:
+            yield UpdateOne({"_id": movie["_id"]}, {"$set": fields})
+
+
+def transform_movies(data: pd.DataFrame, posters: dict) -> dict:
+    """
+    This function converts a chunk of the dataset to the documents to write, in a worker process of the pipeline.
+
+    Args:
+        data: The preprocessed chunk.
+        posters: A dictionary mapping the imdb_id of the movies to their poster url.
+
+    Returns:
+        The number of rows of the chunk, its movie documents (with tmdb_id and source_hash, the hash of the row and
+        of the poster) and its troupe documents.
+    """
+    movies, troupe_data = get_movies_and_troupe(data, posters)
+
+    # the hash of the row and of its poster tells whether the movie changed since it was imported (a poster that
+    # could not be fetched is the placeholder, written again once it is)
+    hashed = data.assign(poster=[movie["poster"] for movie in movies])
+    source_hashes = [f"{value:016x}" for value in pd.util.hash_pandas_object(hashed, index=False).tolist()]
+    for movie, tmdb_id, source_hash in zip(movies, data["id"].tolist(), source_hashes):
+        movie["tmdb_id"] = tmdb_id
+        movie["source_hash"] = source_hash
+
+    return {"rows": len(data), "movies": movies, "troupe": troupe_data}
+
+
+def write_movies(chunk: dict, db, incremental: bool = False) -> dict:
+    """
+    This function writes a converted chunk of the dataset: the movies are upserted by their TMDB id (by title and
+    release year for the ones imported before it was stored) and the troupe by full name, so writing the same chunk
+    again does not duplicate anything.
+
+    Args:
+        chunk: The chunk, as returned by transform_movies.
+        db: The database.
+        incremental: Skip the movies whose row did not change since the last import (same source_hash).
+
+    Returns:
+        The statistics of the chunk: rows, written movies and skipped (unchanged) movies.
+    """
+    movie_coll = db["movie"]
+    troupe_coll = db["troupe"]
+    chunk_movies = chunk["movies"]
+    troupe_data = chunk["troupe"]
+
+    existing = {movie["tmdb_id"]: movie for movie in movie_coll.find(
+        {"tmdb_id": {"$in": [movie["tmdb_id"] for movie in chunk_movies]}}, {"tmdb_id": 1, "source_hash": 1})}
+
+    # the movies imported before the TMDB id was stored are matched by title and release year, the upsert adds it
+    legacy_movies = [movie for movie in chunk_movies if movie["tmdb_id"] not in existing]
+    if legacy_movies:
+        legacy = {}
+        for movie in movie_coll.find({"tmdb_id": {"$exists": False},
+                                      "title": {"$in": list({movie["title"] for movie in legacy_movies})}},
+                                     {"title": 1, "release_year": 1}):
+            legacy.setdefault((movie["title"], movie.get("release_year")), movie)
+
+        for movie in legacy_movies:
+            if (movie["title"], movie["release_year"]) in legacy:
+                existing[movie["tmdb_id"]] = legacy.pop((movie["title"], movie["release_year"]))
+
+    if incremental:
+        chunk_movies = [movie for movie in chunk_movies
+                        if existing.get(movie["tmdb_id"], {}).get("source_hash") != movie["source_hash"]]
+        if not chunk_movies:
+            return {"rows": chunk["rows"], "written": 0, "skipped": chunk["rows"]}
+
+        # the credits of the unchanged movies are not written again
+        changed = {(movie["title"], movie["release_year"]) for movie in chunk_movies}
+        troupe_data = [{**troupe, "movies": [movie for movie in troupe["movies"]
+                                             if (movie["title"], movie["release_year"]) in changed]}
+                       for troupe in troupe_data]
+        troupe_data = [troupe for troupe in troupe_data if troupe["movies"]]
+
+    # the ids of the new movies are generated here, the upsert only sets them when it inserts the movie
+    for movie in chunk_movies:
+        movie["_id"] = existing[movie["tmdb_id"]]["_id"] if movie["tmdb_id"] in existing else ObjectId()
+
+    # the members are created first, without their credits, so that the movies can reference them
+    bulk_write_batches(troupe_coll, (
+        UpdateOne({"full_name": troupe["full_name"]},
+                  {"$setOnInsert": {"type": troupe["type"], "picture": troupe["picture"], "movies": []}},
+                  upsert=True)
+        for troupe in troupe_data
+    ))
+
+    set_troupe_references(chunk_movies, troupe_coll)
+
+    # then the movies, so that a chunk interrupted after this write finds them by TMDB id when it is written again.
+    # The statistics kept by the app (reviews, counts) are only initialized, a re-import does not reset them
+    bulk_write_batches(movie_coll, (
+        UpdateOne({"_id": movie["_id"]} if movie["tmdb_id"] in existing else {"tmdb_id": movie["tmdb_id"]},
+                  {"$set": {field: value for field, value in movie.items()
+                            if field != "_id" and field not in MOVIE_STATS_FIELDS},
+                   "$setOnInsert": {"_id": movie["_id"], **{field: movie[field] for field in MOVIE_STATS_FIELDS}}},
+                  upsert=True)
+        for movie in chunk_movies
+    ))
+
+    # and last the credits, which only reference movies that exist
+    update_troup_data_with_movie_ids(troupe_data=troupe_data, movies=chunk_movies)
+
+    # the credits of the movies imported before are replaced, the cast may have changed
+    reimported_ids = [movie["_id"] for movie in chunk_movies if movie["tmdb_id"] in existing]
+    if reimported_ids:
+        troupe_coll.update_many({"movies._id": {"$in": reimported_ids}},
+                                {"$pull": {"movies": {"_id": {"$in": reimported_ids}}}})
+
+    bulk_write_batches(troupe_coll, (
+        UpdateOne({"full_name": troupe["full_name"]}, {"$push": {"movies": {"$each": troupe["movies"]}}})
+        for troupe in troupe_data
+    ))
+
+    return {"rows": chunk["rows"], "written": len(chunk_movies), "skipped": chunk["rows"] - len(chunk_movies)}
+
+
+def generate_fake_data(db, checkpoint_coll) -> tuple[int, int]:
+    """
+    This function generates the fake users and reviews, once per database, from a random sample of
+    FAKE_DATA_MOVIES movies. The ids of the generated documents are recorded in the checkpoint collection before
+    they are inserted, so that an interrupted generation is undone by the next run before starting again.
+
+    Returns:
+        The number of inserted users and reviews.
+    """
+    movie_coll = db["movie"]
+    checkpoint = checkpoint_coll.find_one({"_id": "fake_data"})
+
+    if checkpoint and checkpoint["done"]:
+        print("The fake users and reviews were already generated")
+        return 0, 0
+
+    if checkpoint:
+        db["user"].delete_many({"_id": {"$in": checkpoint["user_ids"]}})
+        db["review"].delete_many({"_id": {"$in": checkpoint["review_ids"]}})
+        movie_coll.update_many({"_id": {"$in": checkpoint["movie_ids"]}},
+                               {"$set": {"reviews": [], "watched_count": 0, "added_count": 0},
+                                "$unset": {"vote_average": "", "vote_sum": "", "vote_count": ""}})
+
+    movies = list(movie_coll.aggregate([{"$sample": {"size": FAKE_DATA_MOVIES}},
+                                        {"$project": {"title": 1, "poster": 1}}]))
+    for movie in movies:
+        movie.update({"reviews": [], "watched_count": 0, "added_count": 0})
+
+    users = generate_user(movies=movies)
+    for user in users:
+        user["_id"] = ObjectId()
+
+    reviews = generate_reviews(movies=movies, users=[{"_id": user["_id"], "username": user["username"]}
+                                                     for user in users])
+    for review in reviews:
+        review["_id"] = ObjectId()
+
+    checkpoint_coll.replace_one({"_id": "fake_data"}, {
+        "_id": "fake_data",
+        "done": False,
+        "user_ids": [user["_id"] for user in users],
+        "review_ids": [review["_id"] for review in reviews],
+        "movie_ids": [movie["_id"] for movie in movies],
+    }, upsert=True)
+
+    users_ids = db["user"].insert_many(users)
+    if not users_ids.inserted_ids:
+        raise ValueError("No user was inserted")
+
+    review_ids = db["review"].insert_many(reviews)
+    if not review_ids.inserted_ids:
+        raise ValueError("No review was inserted")
+
+    # the added and watched counts, the vote metrics and the review array of every movie, in one update
+    bulk_write_batches(movie_coll, get_movie_stats_updates(movies, reviews))
+
+    checkpoint_coll.update_one({"_id": "fake_data"}, {"$set": {"done": True}})
+
+    return len(users_ids.inserted_ids), len(review_ids.inserted_ids)
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Load the TMDB dataset into the database")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only write the movies whose row changed since the last import")
+    parser.add_argument("--restart", action="store_true",
+                        help="start from the first chunk even if the previous import was interrupted")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS,
+                        help="processes converting the chunks in parallel, 0 to import in a single process")
+    args = parser.parse_args()
+
     client = open_connection()
     db_name = get_db_name()
     if db_name is None:
@@ -155,15 +511,13 @@ def main():
 
     # create Movie collection
     movie_coll = db["movie"]
-    # create Rating collection
-    review_coll = db["review"]
     # create Troupe collection
     troupe_coll = db["troupe"]
 
     # create User collection. The validation schema ensures that each user document will have the same
     # structure
     if "user" not in db.list_collection_names():
-        user_coll = db.create_collection("user", validator={
+        db.create_collection("user", validator={
             "$jsonSchema": {
                 "bsonType": "object",
                 "required": ["username", "email", "password"],
@@ -217,117 +571,91 @@ def main():
                 }
             }
         })
-    else:
-        user_coll = db["user"]
 
-    data = pre_process_data("TMDB_all_movies.csv")
-    movies, troupe_data = get_movies_and_troupe(data)
-    movies_ids = movie_coll.insert_many(movies)
-    update_coll_with_ids(movies, movies_ids)
-
-    # update troupe data with movie ids
-    update_troup_data_with_movie_ids(troupe_data=troupe_data, movies=movies)
-
-    users = generate_user(movies=movies)
-
-    if len(movies_ids.inserted_ids) == 0:
-        close_connection(client)
-        raise ValueError("No movies were inserted")
-
-    troupe_ids = troupe_coll.insert_many(troupe_data)
-
-    if troupe_ids.inserted_ids == 0:
-        movie_coll.delete_many({})
-        close_connection(client)
-        raise ValueError("No troupe data was inserted")
+    # the dataset is read, converted and written one chunk at a time, so that the memory used does not depend on
+    # its size. Every completed chunk is recorded in the checkpoint collection, an interrupted import is resumed
+    data_path = "TMDB_all_movies.csv"
+    if INGEST_CHUNK_SIZE:
+        chunks = read_movie_chunks(data_path, INGEST_CHUNK_SIZE)
     else:
-        troupe_groups = troupe_coll.aggregate([
-            {'$unwind': '$movies'},  # Unwind the movies array
-            {'$group': {
-                '_id': {
-                    'movie_id': '$movies._id',  # Group by movie_id from the movies array
-                    'troupe_type': '$type'  # Group by type
-                },
-                'troupes': {
-                    '$push': {
-                        '_id': '$_id',
-                        'full_name': '$full_name',
-                        'picture': '$picture'
-                    }
-                }
-            }}
-        ])
-
-        for group in troupe_groups:
-            movie_id = group['_id']['movie_id']
-            type_ = group['_id']['troupe_type']
-            troupes = group['troupes']
-
-            update_field = 'directors' if type_ == 'director' else 'actors'
-
-            movie_coll.update_one(
-                {'_id': movie_id},
-                {'$set': {update_field: troupes}}
-            )
-
-        users_ids = user_coll.insert_many(users)
-
-    if users_ids.inserted_ids == 0:
-        troupe_coll.delete_many({})
-        movie_coll.delete_many({})
+        chunks = [pre_process_data(data_path)]
+
+    checkpoint_coll = db["ingestion_checkpoint"]
+    checkpoint = IngestionCheckpoint(checkpoint_coll, "movies",
+                                     get_source_id(data_path, chunk_size=INGEST_CHUNK_SIZE, max_movies=MAX_MOVIES,
+                                                   incremental=args.incremental),
+                                     restart=args.restart)
+
+    # the upserts look the movies up by TMDB id and the troupe by full name, the unique indexes keep the concurrent
+    # writers from inserting the same movie or member twice
+    movie_coll.create_indexes([index for index in INDEXES["movie"] if index.document["name"] == "tmdb_id"])
+    if not troupe_coll.index_information().get("full_name", {}).get("unique"):
+        print(f"Merged {merge_duplicate_troupe(troupe_coll, movie_coll)} duplicate troupe members")
+    troupe_coll.create_indexes(INDEXES["troupe"])
+    poster_resolver = create_poster_resolver()
+    counters = ThroughputCounters()
+
+    def tasks():
+        # read the chunks not written yet and resolve their posters, in the main process
+        read_count = 0
+        chunk_iterator = enumerate(chunks)
+
+        while True:
+            start = time.perf_counter()
+            chunk_idx, data = next(chunk_iterator, (None, None))
+            if data is None:
+                return
+
+            # the chunks written by the interrupted import are still read, to know the ids they contain
+            if checkpoint.is_chunk_done(chunk_idx):
+                read_count += checkpoint.chunks[chunk_idx]["rows"]
+                continue
+
+            if MAX_MOVIES:
+                if read_count >= MAX_MOVIES:
+                    return
+                data = data.head(MAX_MOVIES - read_count)
+            read_count += len(data)
+            counters.add("read", len(data), time.perf_counter() - start)
+
+            # e.g. a chunk of old movies only
+            if data.empty:
+                checkpoint.complete_chunk(chunk_idx, {"rows": 0, "written": 0, "skipped": 0})
+                continue
+
+            start = time.perf_counter()
+            # the posters are fetched concurrently before building the documents (POSTER_BACKEND=stub to run offline)
+            posters = poster_resolver.resolve(data["imdb_id"])
+            counters.add("posters", len(data), time.perf_counter() - start)
+
+            yield chunk_idx, (data, posters)
+
+    def write(chunk_idx: int, chunk: dict) -> int:
+        # the movies of a chunk interrupted while it was written look unchanged, but their credits may be missing
+        incremental = args.incremental and not checkpoint.was_interrupted(chunk_idx)
+        checkpoint.start_chunk(chunk_idx)
+        stats = write_movies(chunk, db, incremental)
+        checkpoint.complete_chunk(chunk_idx, stats)
+        return stats["rows"]
+
+    run_pipeline(tasks(), transform_movies, write, workers=args.workers, writers=INGEST_WRITERS,
+                 queue_size=INGEST_QUEUE_SIZE, counters=counters)
+    checkpoint.complete()
+
+    movies_count = sum(stats["rows"] for stats in checkpoint.chunks.values())
+    written_count = sum(stats["written"] for stats in checkpoint.chunks.values())
+
+    if movies_count == 0:
         close_connection(client)
-        raise ValueError("No user was inserted")
-    else:
-        for movie in movies:
-            movie_coll.update_one({"_id": movie["_id"]}, {"$set": {"added_count": movie["added_count"],
-                                                                   "watched_count": movie["watched_count"]}})
+        raise ValueError("No movies were found in the dataset")
 
-    update_coll_with_ids(users, users_ids)
+    users_count, reviews_count = generate_fake_data(db, checkpoint_coll)
 
-    reviews = generate_reviews(movies=movies, users=[{"_id": user["_id"], "username": user["username"]}
-                                                     for user in users])
-    review_ids = review_coll.insert_many(reviews)
+    # indexes are built once the data is loaded, instead of being maintained by every insert
+    provision_indexes(db)
 
-    if review_ids.inserted_ids == 0:
-        user_coll.delete_many({})
-        troupe_coll.delete_many({})
-        movie_coll.delete_many({})
-        close_connection(client)
-        raise ValueError("No review was inserted")
-    else:
-        # update movies with review array
-        movie_vote_metrics = review_coll.aggregate([{
-            '$group': {
-                '_id': '$movie_id',
-                'vote_average': {'$avg': '$vote'},  # Calculate average rating
-                'vote_count': {'$sum': 1}  # Count number of reviews
-            }
-        }])
-
-        for metrics in movie_vote_metrics:
-            movie_id = metrics['_id']
-            vote_average = metrics['vote_average']
-            vote_count = metrics['vote_count']
-
-            # Update movie document in movie_collection
-            movie_coll.update_one(
-                {'_id': movie_id},
-                {'$set': {
-                    'vote_average': round(vote_average, 2),
-                    'vote_count': vote_count
-                }}
-            )
-
-        movies_with_reviews = []
-        for movie in movies:
-            if movie["reviews"] and len(movie["reviews"]) > 0:
-                movies_with_reviews.append(movie)
-
-        for movie in movies_with_reviews:
-            movie_coll.update_one({"_id": movie["_id"]}, {"$set": {"reviews": movie["reviews"]}})
-
-    print(f"Inserted {len(movies_ids.inserted_ids)} movies\nInserted {len(troupe_ids.inserted_ids)} troupe data\n" +
-          f"Inserted {len(users_ids.inserted_ids)} users\nInserted {len(review_ids.inserted_ids)} reviews")
+    print(f"Imported {movies_count} movies: {written_count} written, {movies_count - written_count} unchanged\n" +
+          f"Inserted {users_count} users\nInserted {reviews_count} reviews")
     close_connection(client)
 
 
@@ -0,0 +1,106 @@
+import argparse
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from backend.indexes import ensure_indexes
+from utils.connection import open_connection, close_connection, get_db_name
+
+
+def user_movies_from_list(user: dict, migrated_at: datetime) -> list[dict]:
+    """
+    This function converts the embedded movies_list of a user to documents of the user_movie collection.
+
+    Args:
+        user: The user document, with its movies_list.
+        migrated_at: The time of the migration, used as added_at of the entries that do not have one.
+
+    Returns:
+        The user_movie documents, in the order of the embedded list.
+    """
+    movies_list = user.get("movies_list") or []
+    user_movies = []
+
+    for idx, entry in enumerate(movies_list):
+        # older entries have no added_at: keep the list order, the last entry being the most recently added
+        added_at = entry.get("added_at") or migrated_at - timedelta(milliseconds=len(movies_list) - idx)
+
+        user_movies.append({
+            "user_id": user["_id"],
+            "movie_id": entry["_id"],
+            "title": entry.get("title"),
+            "poster": entry.get("poster"),
+            "watched": entry.get("watched", False),
+            "favourite": entry.get("favourite", False),
+            "added_at": added_at,
+        })
+
+    return user_movies
+
+
+def migrate_user_lists(db, batch_size: int = 1000, drop_embedded: bool = False) -> int:
+    """
+    This function copies the embedded user lists to the user_movie collection (USER_LIST_STORAGE=collection).
+    The entries are upserted on (user_id, movie_id), so the migration can be run again after a failure.
+
+    Args:
+        db: The database.
+        batch_size: The number of entries written with a single bulk write.
+        drop_embedded: Whether to empty the embedded movies_list of the migrated users.
+
+    Returns:
+        The number of migrated entries.
+    """
+    ensure_indexes(db)
+    migrated_at = datetime.now()
+    migrated = 0
+    updates = []
+    user_ids = []
+
+    def flush():
+        nonlocal migrated, updates, user_ids
+        if updates:
+            db.user_movie.bulk_write(updates, ordered=False)
+            migrated += len(updates)
+        if drop_embedded and user_ids:
+            db.user.update_many({"_id": {"$in": user_ids}}, {"$set": {"movies_list": []}})
+        updates = []
+        user_ids = []
+
+    users = db.user.find({"movies_list.0": {"$exists": True}}, {"movies_list": 1})
+
+    for user in users:
+        for user_movie in user_movies_from_list(user, migrated_at):
+            updates.append(UpdateOne({"user_id": user_movie["user_id"], "movie_id": user_movie["movie_id"]},
+                                     {"$setOnInsert": user_movie}, upsert=True))
+        user_ids.append(user["_id"])
+
+        if len(updates) >= batch_size:
+            flush()
+
+    flush()
+
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move the embedded user lists to the user_movie collection")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--drop-embedded", action="store_true",
+                        help="empty user.movies_list once its entries are copied")
+    args = parser.parse_args()
+
+    client = open_connection()
+    db_name = get_db_name()
+    if db_name is None:
+        raise ValueError("DB_NAME is not set in .env file")
+
+    db = getattr(client, db_name)
+    migrated = migrate_user_lists(db, batch_size=args.batch_size, drop_embedded=args.drop_embedded)
+
+    print(f"Migrated {migrated} user list entries, set USER_LIST_STORAGE=collection to use them")
+    close_connection(client)
+
+
+if __name__ == "__main__":
+    main()
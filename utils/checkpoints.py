@@ -0,0 +1,55 @@
+import os
+from datetime import datetime
+
+
+def get_source_id(data_path: str, **settings) -> dict:
+    """
+    This function identifies an import: the dataset file (path, size and modification time) and the settings that
+    change how it is split in chunks. A checkpoint is only resumed by an import with the same source id.
+    """
+    stat = os.stat(data_path)
+    return {"path": os.path.abspath(data_path), "size": stat.st_size, "mtime": stat.st_mtime_ns, **settings}
+
+
+class IngestionCheckpoint:
+    """
+    The progress of a stage of the import, stored in a document of the checkpoint collection: the chunks already
+    written, with their statistics, and whether the whole stage is done.
+
+    An interrupted import of the same source resumes from its first incomplete chunk, while a completed one (or a
+    different source) starts again from the first chunk.
+    """
+
+    def __init__(self, collection, stage: str, source: dict, restart: bool = False):
+        self.collection = collection
+        self.stage = stage
+
+        checkpoint = collection.find_one({"_id": stage})
+
+        if restart or not checkpoint or checkpoint.get("done") or checkpoint.get("source") != source:
+            checkpoint = {"_id": stage, "source": source, "chunks": {}, "started": [], "done": False,
+                          "started_at": datetime.now()}
+            collection.replace_one({"_id": stage}, checkpoint, upsert=True)
+        else:
+            print(f"Resuming the {stage} import after {len(checkpoint['chunks'])} chunks")
+
+        # the keys of a document are strings
+        self.chunks = {int(chunk_idx): stats for chunk_idx, stats in checkpoint["chunks"].items()}
+        # the chunks the interrupted import started to write, but did not complete
+        self.interrupted = set(checkpoint.get("started", [])) - set(self.chunks)
+
+    def is_chunk_done(self, chunk_idx: int) -> bool:
+        return chunk_idx in self.chunks
+
+    def was_interrupted(self, chunk_idx: int) -> bool:
+        return chunk_idx in self.interrupted
+
+    def start_chunk(self, chunk_idx: int):
+        self.collection.update_one({"_id": self.stage}, {"$addToSet": {"started": chunk_idx}})
+
+    def complete_chunk(self, chunk_idx: int, stats: dict):
+        self.chunks[chunk_idx] = stats
+        self.collection.update_one({"_id": self.stage}, {"$set": {f"chunks.{chunk_idx}": stats}})
+
+    def complete(self):
+        self.collection.update_one({"_id": self.stage}, {"$set": {"done": True, "finished_at": datetime.now()}})
@@ -0,0 +1,135 @@
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Iterable, Tuple
+
+
+class ThroughputCounters:
+    """
+    Rows processed and time spent by every stage of a pipeline, shared by its threads.
+    """
+
+    def __init__(self, report_interval: float = 10):
+        self.report_interval = report_interval
+        self.rows = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.started_at = time.monotonic()
+        self._last_report = self.started_at
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, rows: int, seconds: float):
+        with self._lock:
+            self.rows[stage] += rows
+            self.seconds[stage] += seconds
+
+    def report(self, force: bool = False):
+        """
+        Print the rows per second of every stage (of its own busy time) and of the whole pipeline, at most once
+        every report_interval seconds unless forced.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_report < self.report_interval:
+            return
+
+        self._last_report = now
+        with self._lock:
+            stages = [f"{stage} {self.rows[stage]} rows ({self.rows[stage] / max(self.seconds[stage], 1e-9):.0f}/s)"
+                      for stage in self.rows]
+        print(f"[{now - self.started_at:.0f}s] " + ", ".join(stages))
+
+
+def _timed(transform: Callable, args: tuple) -> Tuple[Any, float]:
+    # runs in the worker processes, the time is sent back with the result
+    start = time.perf_counter()
+    result = transform(*args)
+    return result, time.perf_counter() - start
+
+
+def run_pipeline(tasks: Iterable[Tuple[int, tuple]], transform: Callable, write: Callable[[int, Any], int],
+                 workers: int = 0, writers: int = 2, queue_size: int = 4, counters: ThroughputCounters = None):
+    """
+    This function runs tasks through a transform stage and a write stage.
+
+    With workers > 0 the transforms run in a pool of processes, at most 2 * workers of them at a time, and their
+    results are put in a queue of queue_size items drained by `writers` threads. When the writers fall behind the
+    queue fills up and stops the submission of new tasks (backpressure), so the memory used stays bounded.
+    With workers = 0 every task is transformed and written in the calling thread.
+
+    Args:
+        tasks: The (task id, arguments of transform) to run, the arguments must be picklable. The rows of a task are
+            counted as the length of its first argument, e.g. a DataFrame.
+        transform: The function converting the arguments of a task, defined at module level (it is pickled).
+        write: The function writing the result of a task, returning the number of rows it wrote.
+        workers: The number of processes of the transform stage.
+        writers: The number of threads of the write stage.
+        queue_size: The number of transformed tasks waiting to be written.
+        counters: The throughput counters, updated with the "transform" and "write" stages.
+    """
+    counters = counters or ThroughputCounters()
+
+    def timed_write(task_id: int, result: Any):
+        start = time.perf_counter()
+        rows = write(task_id, result)
+        counters.add("write", rows, time.perf_counter() - start)
+
+    if workers <= 0:
+        for task_id, args in tasks:
+            result, seconds = _timed(transform, args)
+            counters.add("transform", len(args[0]), seconds)
+            timed_write(task_id, result)
+            counters.report()
+        counters.report(force=True)
+        return
+
+    results = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def drain():
+        while True:
+            item = results.get()
+            if item is None:
+                return
+            # after an error the remaining results are discarded, so that the producer is never blocked
+            if not errors:
+                try:
+                    timed_write(*item)
+                except Exception as e:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=drain, name=f"writer-{idx}", daemon=True) for idx in range(writers)]
+    for thread in threads:
+        thread.start()
+
+    def enqueue(task_id: int, future, rows: int):
+        result, seconds = future.result()
+        counters.add("transform", rows, seconds)
+        # blocks while the queue is full
+        results.put((task_id, result))
+        counters.report()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+
+            for task_id, args in tasks:
+                if errors:
+                    break
+
+                pending.append((task_id, executor.submit(_timed, transform, args), len(args[0])))
+                if len(pending) >= 2 * workers:
+                    enqueue(*pending.popleft())
+
+            while pending and not errors:
+                enqueue(*pending.popleft())
+    finally:
+        for _ in threads:
+            results.put(None)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    counters.report(force=True)
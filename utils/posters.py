@@ -0,0 +1,205 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, Optional
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+load_dotenv()
+
+PLACEHOLDER_POSTER = "https://castlewoodassistedliving.com/wp-content/uploads/2021/01/image-coming-soon-placeholder.png"
+
+
+class PosterError(Exception):
+    pass
+
+
+class OmdbPosterBackend:
+    """
+    Read the posters from the OMDb API, with a shared session (connection reuse), a timeout and retries with
+    exponential backoff on connection errors, 429 and 5xx responses.
+    """
+
+    url = "http://www.omdbapi.com/"
+
+    def __init__(self, api_key: Optional[str], timeout: float = 10, retries: int = 3, pool_size: int = 8):
+        if not api_key:
+            raise ValueError("OMDB_API_KEY is not set in .env file, use POSTER_BACKEND=stub to run offline")
+
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = requests.Session()
+
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["GET"])
+        self.session.mount("http://", HTTPAdapter(max_retries=retry, pool_maxsize=pool_size))
+        self.session.mount("https://", HTTPAdapter(max_retries=retry, pool_maxsize=pool_size))
+
+    def fetch(self, imdb_id: str) -> Optional[str]:
+        """
+        Returns:
+            The poster url, or None if OMDb has no poster for the movie.
+
+        Raises:
+            PosterError: If the poster could not be read, e.g. the daily request limit was reached.
+        """
+        try:
+            response = self.session.get(self.url, params={"i": imdb_id, "apikey": self.api_key},
+                                        timeout=self.timeout)
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise PosterError(f"Could not read the poster of {imdb_id}: {e}")
+
+        if response.status_code != 200:
+            raise PosterError(f"Could not read the poster of {imdb_id}: {data.get('Error', response.status_code)}")
+
+        poster = data.get("Poster")
+        return poster if poster and poster != "N/A" else None
+
+
+class StubPosterBackend:
+    """
+    Offline backend for test runs: the posters come from a dictionary, the others are missing.
+    """
+
+    def __init__(self, posters: Optional[Dict[str, str]] = None):
+        self.posters = posters or {}
+
+    def fetch(self, imdb_id: str) -> Optional[str]:
+        return self.posters.get(imdb_id)
+
+
+class RateLimiter:
+    """
+    Space the calls of all the threads so that at most `rate` of them start every second (0 for no limit).
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self._next_call = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            call_at = max(self._next_call, now)
+            self._next_call = call_at + self.interval
+
+        time.sleep(call_at - now)
+
+
+class PosterCache:
+    """
+    imdb_id -> poster url (None when there is no poster), stored in a JSON file so that the next runs skip the
+    known ids.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.posters = {}
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.posters = json.load(f)
+
+    def __contains__(self, imdb_id: str) -> bool:
+        return imdb_id in self.posters
+
+    def get(self, imdb_id: str) -> Optional[str]:
+        return self.posters.get(imdb_id)
+
+    def set(self, imdb_id: str, poster: Optional[str]):
+        with self._lock:
+            self.posters[imdb_id] = poster
+
+    def save(self):
+        if not self.path:
+            return
+
+        with self._lock:
+            # write a temporary file first, an interrupted run must not corrupt the cache
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.posters, f)
+            os.replace(tmp_path, self.path)
+
+
+class PosterResolver:
+    """
+    Resolve the posters of many movies concurrently, with a pool of threads sharing the backend (and its session).
+    """
+
+    def __init__(self, backend, cache: PosterCache, workers: int = 8, rate: float = 10, save_every: int = 500):
+        self.backend = backend
+        self.cache = cache
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.save_every = save_every
+
+    def _fetch(self, imdb_id: str) -> Optional[str]:
+        self.rate_limiter.wait()
+        return self.backend.fetch(imdb_id)
+
+    def resolve(self, imdb_ids: Iterable[str]) -> Dict[str, str]:
+        """
+        This function reads the posters of the ids that are not cached yet and caches them.
+
+        Args:
+            imdb_ids: The IMDb ids of the movies, duplicates are fetched once.
+
+        Returns:
+            A dictionary mapping every id to its poster url, or to PLACEHOLDER_POSTER if the movie has none or the
+            poster could not be read. The failed ids are not cached, they are fetched again by the next run.
+        """
+        imdb_ids = list(dict.fromkeys(imdb_ids))
+        missing = [imdb_id for imdb_id in imdb_ids if imdb_id not in self.cache]
+        failed = 0
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(self._fetch, imdb_id): imdb_id for imdb_id in missing}
+
+                for idx, future in enumerate(as_completed(futures), start=1):
+                    try:
+                        self.cache.set(futures[future], future.result())
+                    except PosterError as e:
+                        print(e)
+                        failed += 1
+
+                    if idx % self.save_every == 0:
+                        self.cache.save()
+
+            self.cache.save()
+
+        print(f"Resolved {len(imdb_ids)} posters: {len(imdb_ids) - len(missing)} cached, "
+              f"{len(missing) - failed} fetched, {failed} failed")
+
+        return {imdb_id: self.cache.get(imdb_id) or PLACEHOLDER_POSTER for imdb_id in imdb_ids}
+
+
+def create_poster_resolver() -> PosterResolver:
+    """
+    This function creates the resolver configured in the .env file:
+    POSTER_BACKEND ("omdb" by default, "stub" for offline runs), POSTER_CACHE_PATH (posters_cache.json, empty to
+    disable the cache), POSTER_WORKERS (8), POSTER_RATE_LIMIT (requests per second, 10) and POSTER_TIMEOUT (10 s).
+    """
+    workers = int(os.getenv("POSTER_WORKERS", 8))
+
+    if os.getenv("POSTER_BACKEND", "omdb") == "stub":
+        # the stub posters are not cached, they would hide the real ones to the next runs
+        return PosterResolver(StubPosterBackend(), PosterCache(None), workers=workers, rate=0)
+
+    backend = OmdbPosterBackend(os.getenv("OMDB_API_KEY"), timeout=float(os.getenv("POSTER_TIMEOUT", 10)),
+                                pool_size=workers)
+
+    return PosterResolver(backend, PosterCache(os.getenv("POSTER_CACHE_PATH", "posters_cache.json") or None),
+                          workers=workers, rate=float(os.getenv("POSTER_RATE_LIMIT", 10)))